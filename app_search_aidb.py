@@ -1,21 +1,39 @@
-import os
 import io
 import time
-import boto3
-import psycopg2
-import base64
+import heapq
+import numpy as np
 import streamlit as st
 from PIL import Image
 
-from urllib.parse import quote_plus
-from sqlalchemy import create_engine, text
-from utils.db_connection import create_db_connection
-from botocore.handlers import disable_signing
+from utils.db_connection import primary_connection, run_read
+from utils.product_catalog import CatalogCache
+from utils.facets import FacetIndex
+from utils.autocomplete import Autocomplete
+from utils.query_log import get_query_log
+from utils import queries
+from utils.admission import Overloaded, admit, all_metrics, start_metrics_server
+from utils.search import search_image, search_text
+from utils.image_store import fetch_images
 
 # Custom Header Section
 logo_path = "code/edb_new.png"
 primary_color = "#FF4B33"
 
+# Filters offered next to the gender selection, by products column
+FACET_LABELS = {
+    "mastercategory": "Category",
+    "subcategory": "Sub category",
+    "basecolour": "Colour",
+    "season": "Season",
+    "usage": "Usage",
+}
+
+# Number of search results, and the smaller number returned while searches queue
+TEXT_SEARCH_K = 11
+TEXT_SEARCH_K_DEGRADED = 5
+IMAGE_SEARCH_K = 5
+IMAGE_SEARCH_K_DEGRADED = 3
+
 
 header_css = f"""
 <style>
@@ -58,177 +76,191 @@ st.markdown("## EDB Postgres AI")
 
 
 
-# Build database URL with proper error handling
-db_user = os.getenv("DB_USER") or ""
-db_host = os.getenv("DB_HOST") or "localhost"
-db_port = os.getenv("DB_PORT") or "5432"
-db_name = os.getenv("DB_NAME") or ""
+@st.cache_resource
+def _catalog_cache():
+    return CatalogCache()
+
+
+def get_catalog():
+    """Return the in-memory product catalog, reloaded when the products table changes."""
+    # The fingerprint relies on table statistics, which only the primary keeps
+    # for its own writes, so the catalog is loaded from the primary
+    with primary_connection() as conn:
+        return _catalog_cache().get(conn)
+
+
+@st.cache_resource(max_entries=1)
+def _facet_index(_catalog, fingerprint):
+    return FacetIndex(_catalog)
+
+
+def get_facets():
+    """Return the facet bitmap index of the current catalog."""
+    catalog = get_catalog()
+    return _facet_index(catalog, catalog.fingerprint)
+
+
+@st.cache_resource
+def _autocomplete_index():
+    return Autocomplete(get_catalog())
 
-DATABASE_URL = "postgresql://%s@%s:%s/%s" % (
-    quote_plus(db_user), 
-    db_host, 
-    db_port, 
-    db_name
-)
 
-engine = create_engine(DATABASE_URL)
+def get_autocomplete():
+    """Return the type-ahead index, updated with products added since it was built."""
+    index = _autocomplete_index()
+    index.update_from_catalog(get_catalog())
+    return index
+
+
+def _use_suggestion(suggestion):
+    st.session_state.search_query = suggestion
+
 
-@st.cache_data
 def get_categories():
-    query = text("SELECT DISTINCT masterCategory FROM products order by 1;")
-    with engine.connect() as connection:
-        result = connection.execute(query)
-        # Fetch the result set as a list of dictionaries for easier access
-        categories = [row["mastercategory"] for row in result.mappings().all()]
-    return categories
-
-@st.cache_data
+    return get_catalog().values("mastercategory")
+
+
 def get_genders():
-    query = text("SELECT DISTINCT gender FROM products order by 1;")
-    with engine.connect() as connection:
-        result = connection.execute(query)
-        # Fetch the result set as a list of dictionaries for easier access
-        genders = [row["gender"] for row in result.mappings().all()]
-    return genders
+    return get_catalog().values("gender")
 
 
-@st.cache_data
 def get_products_by_category(category):
-    query = text(
-        "SELECT productDisplayName, product_idFROM products WHERE masterCategory = :category order by 1 limit 30;"
-    )
-    with engine.connect() as connection:
-        result = connection.execute(query, {"category": category})
-        # Convert the result to a list of dictionaries
-        products = [
-            {
-                "name": row["productdisplayname"],
-                "image_path": f'dataset/images/{row["img_id"]}.jpg',
-            }
-            for row in result.mappings().all()
-        ]
-    return products
-
-
-@st.cache_data
-def get_product_details_in_category(img_id):
+    """Return the first 30 products of a category, ordered by name."""
+    catalog = get_catalog()
+    rows = np.flatnonzero(catalog.mask(mastercategory=category))
+    first_rows = heapq.nsmallest(30, rows, key=catalog.name)
+    return catalog.hydrate([catalog.product_id(row) for row in first_rows])
+
+
+def show_products(product_ids, start_time):
     """
-    Fetch product details for a given category by image ID.
+    Render the products progressively.
 
-    Args:
-        product_id(str): The image ID to search for in the database.
+    Names and review links are rendered at once with a placeholder per
+    image, then the S3 images are fetched concurrently and each one fills its
+    placeholder as soon as it arrives.
 
+    Args:
+        product_ids (list): products to show, in order.
+        start_time (float): time.time() the search started at.
     Returns:
-        dict: A dictionary containing product name and image path.
+        dict: time_to_first_result_ms and time_to_complete_ms.
     """
-
-    query = text(
-        "SELECT productDisplayName, product_id FROM products WHERE product_id = :img_id;"
+    placeholders = {}
+    for product in get_catalog().hydrate(product_ids):
+        col_img, col_button = st.columns([3, 1])
+        with col_img:
+            st.write(f"**{product['name']}**")
+            # uncomment the below two lines to display the image from local dataset folder
+            # image = Image.open(product["image_path"])
+            # st.image(image, width=150)
+            # display image from S3
+            result = product["product_id"] + ".jpg" # Image name should include the extension
+            placeholders[result] = st.empty()
+            placeholders[result].caption("Loading image...")
+        with col_button:
+            st.link_button("Review", f"/review_page/?review_item_id={product['product_id']}")
+    time_to_first_result = time.time() - start_time
+
+    for image_name, image, error in fetch_images(list(placeholders)):
+        if image is not None:
+            placeholders[image_name].image(image, caption=image_name, width=150)
+        else:
+            placeholders[image_name].caption(f"Image not available: {error}")
+    time_to_complete = time.time() - start_time
+    st.caption(
+        f"First results shown after {time_to_first_result:.4f} seconds, "
+        f"all images after {time_to_complete:.4f} seconds."
+    )
+    return {
+        "time_to_first_result_ms": round(time_to_first_result * 1000, 3),
+        "time_to_complete_ms": round(time_to_complete * 1000, 3),
+    }
+
+
+def log_search(mode, query, selections, year_range, k, latency, result_ids, image_bytes=None, by_reviews=False, **timings):
+    """Record the search in the query log, when logging is enabled."""
+    query_log = get_query_log()
+    if query_log is None:
+        return
+    retriever_name = (
+        st.session_state.text_retriever_name if mode == "text" else st.session_state.img_retriever_name
+    )
+    query_log.record(
+        mode,
+        query,
+        {"selections": selections, "year_range": year_range, "by_reviews": by_reviews},
+        k,
+        latency,
+        result_ids,
+        image_bytes,
+        retriever=retriever_name,
+        **timings,
     )
 
-    with engine.connect() as connection:
-        result = connection.execute(query, {"img_id": img_id})
-        # Convert  result to a list of dictionaries
-        product = result.mappings().first()
 
-        if product:
-            product_details = {
-                "name": product["productdisplayname"],
-                "image_path": f'dataset/images/{product["img_id"]}.jpg',
-            }
-        else:
-            product_details = None
-    return product_details
+def show_result_facets(product_ids):
+    """Show how the retrieved products split over the facet values."""
+    counts = get_facets().facet_counts_for_ids(product_ids)
+    with st.expander("Result breakdown"):
+        for column, label in FACET_LABELS.items():
+            values = ", ".join(f"{v} ({n})" for v, n in sorted(counts[column].items()))
+            st.write(f"**{label}:** {values}")
 
-def display_image_s3(image_name, staging_bucket='public-ai-images'):
-    s3 = boto3.resource(
-        service_name="s3",
-        endpoint_url='http://s3.eu-central-1.amazonaws.com',
-    )
-    s3.meta.client.meta.events.register("choose-signer.s3.*", disable_signing)
-    bucket = s3.Bucket(staging_bucket)
-    obj = bucket.Object(image_name)
-    response = obj.get()
-    image_data = response['Body'].read()
-    image = Image.open(io.BytesIO(image_data))
-    st.image(image, caption=image_name, width=150)
-    
-    # s3.meta.client.upload_file(f'{file_path}', 'public-ai-team', f'{image_name}')
-
-def search_catalog(text_query, selected_gender=None):
+
+def search_catalog(text_query, selections, year_range=None, by_reviews=False):
     """
-    This function aims to use  aidb.retrieve_key() to do hybrid search
-    Therefore over sampling on retrieving is required to get the best results
+    This function aims to use  aidb.retrieve_text() to do semantic search
+    Therefore over sampling on retrieving is required when a filter is applied
     Args:       
         text_query (str): The text query to search for in the database.
-        selected_gender (str): 'Men', 'Women', 'Boys', 'Girls' or None
+        selections (dict): facet column -> list of accepted values
+        year_range (tuple): inclusive (first, last) year, or None
+        by_reviews (bool): move well reviewed products up
     Returns:
         None
     """
-    conn = st.session_state.db_conn
-    cur = conn.cursor()
-    
+    facets = get_facets()
+    retriever_name = st.session_state.text_retriever_name
+
     try:
         start_time = time.time()
-        if selected_gender != "None":
-        # Filter products through CLIP Model
-        # This is a hybrid search using text and limited only with the number of images in the S3 bucket
-        # Therefore this search is replaced with text retriever over products table
-
-            cur.execute(
-            f"""WITH filtered_products AS (
-            -- First get all men's products
-            SELECT img_id, productdisplayname
-            FROM products 
-            WHERE gender = '{selected_gender}'
-        )
-        SELECT 
-            result.key as id,
-            result.distance as score
-        FROM filtered_products fp
-        CROSS JOIN LATERAL aidb.retrieve_text('{st.session_state.text_retriever_name}', '{text_query}', 100) AS result
-        WHERE result.key = fp.img_id
-        ORDER BY score ASC LIMIT 11;"""
-        )
-        else:
-            cur.execute(
-                f"""SELECT * FROM aidb.retrieve_text('{st.session_state.text_retriever_name}', '{text_query}', 11);"""
-            )
-        results = cur.fetchall()
-        keys = [row[0].split(',')[0].strip('()') for row in results]
+        with admit("text_search") as congested:
+            # Ask for fewer results while searches are queueing, which also
+            # shrinks the over sampling of filtered searches
+            k = TEXT_SEARCH_K_DEGRADED if congested else TEXT_SEARCH_K
+
+            def retrieve(conn):
+                return search_text(
+                    conn, facets, retriever_name, text_query, k, selections, year_range, by_reviews
+                )
+
+            # Read-only search, served by a replica when one is configured
+            keys = run_read(retrieve)
 
        # Extract only the filenames from the results
         query_time = time.time() - start_time
         st.write(f"Querying similar catalog took {query_time:.4f} seconds.")
+        timings = {}
         if keys:
             st.write(f"Number of elements retrieved: {len(keys)}")
-            for product_idin keys:
-                product = get_product_details_in_category(img_id)
-                if product:
-                    col_img, col_button = st.columns([3, 1])
-                    with col_img:
-                        st.write(f"**{product['name']}**")
-                        # uncomment the below two lines to display the image from local dataset folder
-                        # image = Image.open(product["image_path"])
-                        # st.image(image, width=150)
-                        # display image from S3
-                        result = product_id+ ".jpg" # Image name should include the extension
-                        display_image_s3(result)
-                    with col_button:
-                        st.link_button("Review", f"/review_page/?review_item_id={img_id}")
+            show_result_facets(keys)
+            timings = show_products(keys, start_time)
         else:
             st.error("No results found.")
+        log_search("text", text_query, selections, year_range, k, query_time, keys, by_reviews=by_reviews, **timings)
 
+    except Overloaded:
+        st.warning("Search is busy right now, please try again in a moment.")
     except Exception as e:
         st.error("An error occurred: " + str(e))
-    finally:
-        cur.close()
+
+# Expose the admission metrics over HTTP when ADMISSION_METRICS_PORT is set
+start_metrics_server()
 
 st.session_state.text_retriever_name = "recommend_products"
 st.session_state.img_retriever_name = "recom_images"
 st.session_state.s3_bucket_name = "public-ai-team"
-if "db_conn" not in st.session_state or st.session_state.db_conn.closed:
-    st.session_state.db_conn = create_db_connection()
 # Load the text information data about products into db.
 # load_data_to_db(st.session_state.db_conn, 'dataset/stylesc.csv')
 # Using columns to create a two-part layout
@@ -252,7 +284,45 @@ with left_column:
 with right_column:
     # Text input for search query
     search_query = st.text_input("Enter search term:", "", key="search_query")
-    selected_gender = st.selectbox("Select the gender:", ["None"] + get_genders())
+    # Type-ahead suggestions for the current input
+    suggestions = get_autocomplete().suggest(search_query, k=5) if search_query else []
+    if suggestions and suggestions[0] != search_query:
+        st.caption("Suggestions:")
+        for i, suggestion in enumerate(suggestions):
+            st.button(suggestion, key=f"suggestion_{i}", on_click=_use_suggestion, args=(suggestion,))
+    facets = get_facets()
+    all_years = facets.values("year")
+    selected_years = st.session_state.get("facet_year")
+    year_range = None
+    if all_years and selected_years and tuple(selected_years) != (all_years[0], all_years[-1]):
+        year_range = tuple(selected_years)
+    selections = {column: st.session_state.get(f"facet_{column}", []) for column in FACET_LABELS}
+    selected_gender = st.session_state.get("facet_gender", "None")
+    if selected_gender != "None":
+        selections["gender"] = [selected_gender]
+    # Count per facet value, each facet ignoring its own selection
+    counts = facets.disjunctive_counts(selections, year_range)
+
+    st.selectbox(
+        "Select the gender:",
+        ["None"] + get_genders(),
+        key="facet_gender",
+        format_func=lambda g: g if g == "None" else f"{g} ({counts['gender'].get(g, 0)})",
+    )
+    with st.expander("More filters"):
+        for column, label in FACET_LABELS.items():
+            st.multiselect(
+                label,
+                facets.values(column),
+                key=f"facet_{column}",
+                format_func=lambda v, column=column: f"{v} ({counts[column].get(v, 0)})",
+            )
+        if len(all_years) > 1:
+            st.slider("Year", all_years[0], all_years[-1], (all_years[0], all_years[-1]), key="facet_year")
+        st.caption(f"{facets.count(facets.candidates(selections, year_range))} matching products")
+    by_reviews = st.checkbox(
+        "Rank by reviews", key="rank_by_reviews", help="Move products with a high review rating up the results."
+    )
 
     # File uploader for image
     uploaded_image = st.file_uploader(
@@ -288,67 +358,57 @@ with right_column:
     if execute_search:
         if search_mode == "text":
             st.write(f"Results for '{search_query}':")
-            search_catalog(search_query, selected_gender)
+            search_catalog(search_query, selections, year_range, by_reviews)
         elif search_mode == "image":
             try:
                 # Process and display the uploaded image
                 image_name = uploaded_image.name
                 bytes_data = uploaded_image.getvalue()
-                encoded_data = base64.b64encode(bytes_data).decode('utf-8')
                 image = Image.open(io.BytesIO(bytes_data))
                 
                 st.image(image, caption="Uploaded Image", use_container_width=True)
                 # Generate embeddings for the uploaded image and search
                 start_time = time.time()
-                conn = st.session_state.db_conn
-                cur = conn.cursor()
-
-                with conn.cursor() as cur:
-                    if selected_gender != "None":
-                        cur.execute(
-                        f"""WITH filtered_products AS (
-                        -- First get all men's products
-                        SELECT img_id, productdisplayname
-                        FROM products 
-                        WHERE gender = '{selected_gender}'
-                    )
-                    SELECT 
-                        result.key as id,
-                        result.distance as score
-                    FROM filtered_products fp
-                    CROSS JOIN LATERAL aidb.retrieve_key('{st.session_state.img_retriever_name}', decode('{encoded_data}', 'base64'), 40) AS result
-                    WHERE result.key = CONCAT(fp.img_id, '.jpg')
-                    ORDER BY score ASC LIMIT 5;"""
-                    )
-                    else:
-                        cur.execute(
-                            f"""SELECT aidb.retrieve_key('{st.session_state.img_retriever_name}', decode('{encoded_data}', 'base64'), 5);"""                 
+                facets = get_facets()
+                retriever_name = st.session_state.img_retriever_name
+
+                with admit("image_search") as congested:
+                    k = IMAGE_SEARCH_K_DEGRADED if congested else IMAGE_SEARCH_K
+
+                    def retrieve(conn):
+                        return search_image(
+                            conn, facets, retriever_name, bytes_data, k, selections, year_range, by_reviews
                         )
 
-                    results = cur.fetchall()
-                    keys = [row[0].split(',')[0].strip('()') for row in results]
-                    vector_time = time.time() - start_time
-                    st.write(f"Fetching vector took {vector_time:.4f} seconds.")
-                    if keys:
-                        st.write(f"Number of elements retrieved: {len(keys)}")
-                        for result in keys:
-                            product_id= result.split(".")[0]
-                            product = get_product_details_in_category(img_id)
-                            if product:
-                                col_img, col_button = st.columns([3, 1])
-                                with col_img:
-                                    st.write(f"**{product['name']}**")
-                                    # uncomment the below two lines to display the image from local dataset folder
-                                    # image = Image.open(product["image_path"])
-                                    # st.image(image, width=150)
-                                    # display image from S3
-                                    result = product_id+ ".jpg" # Image name should include the extension
-                                    display_image_s3(result)
-                                with col_button:
-                                    st.link_button("Review", f"/review_page/?review_item_id={img_id}")
-                    else:
-                        st.write("No results found.")
+                    # Read-only search, served by a replica when one is configured
+                    keys = run_read(retrieve)
+                vector_time = time.time() - start_time
+                st.write(f"Fetching vector took {vector_time:.4f} seconds.")
+                timings = {}
+                if keys:
+                    st.write(f"Number of elements retrieved: {len(keys)}")
+                    show_result_facets(keys)
+                    timings = show_products(keys, start_time)
+                else:
+                    st.write("No results found.")
+                log_search(
+                    "image", None, selections, year_range, k, vector_time, keys, bytes_data, by_reviews, **timings
+                )
+            except Overloaded:
+                st.warning("Image search is busy right now, please try again in a moment or search with text.")
             except Exception as e:
                 st.error(f"An error occurred: {e}")
-            finally:
-                cur.close()
+
+with st.sidebar.expander("Load"):
+    load = all_metrics()
+    if load:
+        st.table([{"resource": name, **values} for name, values in sorted(load.items())])
+    else:
+        st.write("No admission controlled calls yet.")
+
+with st.sidebar.expander("Query statistics"):
+    stats = queries.statement_stats()
+    if stats:
+        st.table([{"statement": name, **values} for name, values in sorted(stats.items())])
+    else:
+        st.write("No statements run yet.")
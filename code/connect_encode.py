@@ -4,8 +4,10 @@ import time
 import sys
 import os
 import json
+import argparse
 
-from typing import Tuple, List
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Optional, Set, Tuple, List
 from io import StringIO
 
 from psycopg2.extras import execute_batch
@@ -13,15 +15,11 @@ from psycopg2 import sql
 
 # Add the parent directory of 'code' to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from utils.db_connection import create_db_connection
+from utils.db_connection import create_db_pool
+from utils.review_stats import STATS_TABLE_DDL, rebuild_review_stats
 
-
-def initialize_database(conn):
-    """Initialize the database with required extensions and tables."""
-    with conn.cursor() as cur:
-        _create_extensions(cur)
-        _create_tables(cur)
-        # _populate_test_images_data(cur, '/dataset/images')
+# Per-stage results of the last setup run, used by --retry-failed
+SETUP_STATE_FILE = ".setup_state.json"
 
 
 def _create_extensions(cur):
@@ -34,6 +32,7 @@ def _create_tables(cur):
     """Create required tables."""
     cur.execute("DROP TABLE IF EXISTS products CASCADE;")
     cur.execute("DROP TABLE IF EXISTS product_review;")
+    cur.execute("DROP TABLE IF EXISTS product_review_stats;")
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS products (
@@ -59,6 +58,7 @@ def _create_tables(cur):
             review TEXT
     );"""
     )
+    cur.execute(STATS_TABLE_DDL)
 
 
 def _populate_product_data(conn: psycopg2.extensions.connection, csv_file: str) -> None:
@@ -94,6 +94,7 @@ def _populate_product_data(conn: psycopg2.extensions.connection, csv_file: str)
     except (Exception, psycopg2.Error) as error:
         print(f"Error while inserting data into PostgreSQL: {error}")
         conn.rollback()
+        raise
 
     # Commit and close
     conn.commit()
@@ -122,6 +123,7 @@ def insert_dataframe(
     except (Exception, psycopg2.Error) as error:
         print(f"Error while inserting data into PostgreSQL: {error}")
         connection.rollback()
+        raise
     finally:
         cursor.close()
 
@@ -137,11 +139,18 @@ def populate_product_review_data(
         print(
             f"DataFrame successfully written to the 'product_review' table in the database."
         )
+        start_time = time.time()
+        # A rebuild rather than an update, a rerun of the stage replaces the reviews
+        rebuild_review_stats(conn)
+        conn.commit()
+        print(f"Updating product_review_stats took {time.time() - start_time:.4f} seconds.")
 
     except psycopg2.OperationalError as e:
         print(f"Error connecting to PostgreSQL: {e}")
+        raise
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
+        raise
 
 
 def _populate_test_images_data(cur, image_folder):
@@ -163,111 +172,297 @@ def _populate_test_images_data(cur, image_folder):
             pass
 
 
-def create_and_refresh_retriever(conn):
-    """Create and retriever with bytea image data"""
+def create_image_knowledge_base(cur):
+    """Create the recom_images knowledge base over the S3 bucket, without embedding it."""
+    # Run for S3 bucket
+    # The idea is to create a retriever for the images bucket so the image search can run over it.
+    cur.execute(
+        """SELECT pgfs.create_storage_location('image_bucket_srv', 's3://public-ai-images', options => '{"region":"eu-central-1", "skip_signature": "true"}');"""
+    )
+    cur.execute(
+        """SELECT aidb.create_volume('images_bucket_vol', 'image_bucket_srv', '/', 'Image');"""
+    )
+    cur.execute(
+        """SELECT aidb.create_model('multimodal_clip', 'clip_local');"""
+    )
+    cur.execute(
+        """
+        SELECT aidb.create_volume_knowledge_base(
+        name => 'recom_images'
+        ,model_name => 'multimodal_clip'
+        ,source_volume_name => 'images_bucket_vol'
+        ,batch_size => 500
+    );
+    """
+    )
+
+
+def create_text_retriever(cur):
+    """Create the recommend_products knowledge base over the products table."""
+    # Run retriever for products table
+    # The idea is to create a retriever for the products table so the text search can run over it.
+    config = json.dumps({
+        "model": "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+        "revision": "main"
+    })
+    cur.execute(
+        f"""SELECT aidb.create_model('text-embedding', 
+                    'bert_local', 
+                    '{config}'::JSONB);"""
+    )
+
+    cur.execute(
+        """SELECT aidb.create_table_knowledge_base(
+                name => 'recommend_products'
+                ,model_name => 'text-embedding'
+                ,source_table => 'products'
+                ,source_key_column => 'product_id'
+                ,source_data_column => 'productdisplayname'
+                ,source_data_format => 'Text'
+                ,auto_processing =>'Live'
+                ,batch_size => 1000
+                );"""
+    )
+
+
+def create_review_model(cur):
+    """Create the completions model used for review summaries and labels."""
+    # Create the GenAI Model for summary and level generation
+    # for the review page. If the model is already exist, aidb will skip it.
+    # Use below for the NIM model creation
+    genai_config = json.dumps({
+        "model": "llama3.2-vision",
+        "url": "http://localhost:11434/v1/chat/completions"
+    })
+    cur.execute(
+        f"""SELECT aidb.create_model('product_review_model', 'completions', '{genai_config}'::JSONB);"""
+    )
+
+    # Use below command instead of upper one for the remote model creation
+    # cur.execute(
+    #     f"""select aidb.create_model('product_review_model', 'completions', '{{"model":"llama-31-8b-instruct", "url":"https://llama-31-8b-instruct-samouelian-edb-ai.apps.ai-dev01.kni.syseng.devcluster.openshift.com/v1/chat/completions"}}'::JSONB);"""
+    # )
+
+
+class Stage:
+    """
+    A named setup step and the stages that must succeed before it runs.
+
+    A transactional stage runs with autocommit off and is committed at the
+    end, so a failure rolls back its partial rows or created objects and
+    the stage can simply be rerun.
+    """
+
+    def __init__(
+        self, name: str, func: Callable, depends_on: Tuple[str, ...] = (), transactional: bool = False
+    ):
+        self.name = name
+        self.func = func
+        self.depends_on = depends_on
+        self.transactional = transactional
+
+
+def _with_cursor(func: Callable) -> Callable:
+    """Adapt a cursor-level setup function to take a connection."""
+
+    def run(conn: psycopg2.extensions.connection) -> None:
+        with conn.cursor() as cur:
+            func(cur)
+
+    return run
+
+
+def _bulk_embedding(knowledge_base: str) -> Callable:
+    def run(conn: psycopg2.extensions.connection) -> None:
+        with conn.cursor() as cur:
+            cur.execute("SELECT aidb.bulk_embedding(%s);", (knowledge_base,))
+
+    return run
+
+
+def _reload(table: str, load: Callable) -> Callable:
+    """Empty a table before loading it, so that rerunning the stage does not duplicate rows."""
+
+    def run(conn: psycopg2.extensions.connection) -> None:
+        with conn.cursor() as cur:
+            # DELETE rather than TRUNCATE, the live knowledge base over the table follows row changes
+            cur.execute(sql.SQL("DELETE FROM {};").format(sql.Identifier(table)))
+        load(conn)
+
+    return run
 
-    with conn.cursor() as cur:
+
+def build_setup_stages(products_csv: str, reviews_csv: str) -> List[Stage]:
+    """Return the setup pipeline as a dependency graph of stages."""
+    return [
+        Stage("extensions", _with_cursor(_create_extensions)),
+        Stage("tables", _with_cursor(_create_tables)),
+        Stage(
+            "products",
+            _reload("products", lambda conn: _populate_product_data(conn, products_csv)),
+            ("tables",),
+            transactional=True,
+        ),
+        Stage(
+            "reviews",
+            _reload("product_review", lambda conn: populate_product_review_data(conn, reviews_csv)),
+            ("tables",),
+            transactional=True,
+        ),
+        # Several create calls each: a failure must not leave the first ones behind for the retry
+        Stage("image_kb", _with_cursor(create_image_knowledge_base), ("extensions",), transactional=True),
+        Stage("image_embedding", _bulk_embedding("recom_images"), ("image_kb",)),
+        Stage(
+            "text_kb",
+            _with_cursor(create_text_retriever),
+            ("extensions", "products"),
+            transactional=True,
+        ),
+        Stage("text_embedding", _bulk_embedding("recommend_products"), ("text_kb",)),
+        Stage("review_model", _with_cursor(create_review_model), ("extensions",), transactional=True),
+    ]
+
+
+def _run_stage(stage: Stage, pool) -> float:
+    """Run one stage on its own pooled connection, in autocommit mode unless it is transactional."""
+    conn = pool.getconn()
+    try:
+        conn.autocommit = not stage.transactional
         start_time = time.time()
-        # Run for S3 bucket
-        # The idea is to create a retriever for the images bucket so the image search can run over it.
         try:
-            cur.execute(
-                """SELECT pgfs.create_storage_location('image_bucket_srv', 's3://public-ai-images', options => '{"region":"eu-central-1", "skip_signature": "true"}');"""
-            )
-            cur.execute(
-                """SELECT aidb.create_volume('images_bucket_vol', 'image_bucket_srv', '/', 'Image');"""
-            )
-            cur.execute(
-                """SELECT aidb.create_model('multimodal_clip', 'clip_local');"""
-            )
-            cur.execute(
-                """
-                SELECT aidb.create_volume_knowledge_base(
-                name => 'recom_images'
-                ,model_name => 'multimodal_clip'
-                ,source_volume_name => 'images_bucket_vol'
-                ,batch_size => 500
-            );
-            """
-            )
-            cur.execute(f"""SELECT aidb.bulk_embedding('recom_images');""")
-            vector_time = time.time() - start_time
-            print(
-                f"Creating and refreshing recom_images retriever took {vector_time:.4f} seconds."
-            )
-            start_time = time.time()
-            # Run retriever for products table
-            # The idea is to create a retriever for the products table so the text search can run over it.
-            config = json.dumps({
-                "model": "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
-                "revision": "main"
-            })
-            cur.execute(
-                f"""SELECT aidb.create_model('text-embedding', 
-                            'bert_local', 
-                            '{config}'::JSONB);"""
-            )
+            stage.func(conn)
+            if stage.transactional:
+                conn.commit()
+        except Exception:
+            if stage.transactional:
+                conn.rollback()
+            raise
+        return time.time() - start_time
+    finally:
+        pool.putconn(conn)
 
-            cur.execute(
-                """SELECT aidb.create_table_knowledge_base(
-                        name => 'recommend_products'
-                        ,model_name => 'text-embedding'
-                        ,source_table => 'products'
-                        ,source_key_column => 'product_id'
-                        ,source_data_column => 'productdisplayname'
-                        ,source_data_format => 'Text'
-                        ,auto_processing =>'Live'
-                        ,batch_size => 1000
-                        );"""
-            )
-            # Create the GenAI Model for summary and level generation
-            # for the review page. If the model is already exist, aidb will skip it.
-            # Use below for the NIM model creation
-            genai_config = json.dumps({
-                "model": "llama3.2-vision",
-                "url": "http://localhost:11434/v1/chat/completions"
-            })
-            cur.execute(
-                f"""SELECT aidb.create_model('product_review_model', 'completions', '{genai_config}'::JSONB);"""
-            )
 
-            # Use below command instead of upper one for the remote model creation
-            # cur.execute(
-            #     f"""select aidb.create_model('product_review_model', 'completions', '{{"model":"llama-31-8b-instruct", "url":"https://llama-31-8b-instruct-samouelian-edb-ai.apps.ai-dev01.kni.syseng.devcluster.openshift.com/v1/chat/completions"}}'::JSONB);"""
-            # )
-        except Exception as e:
-            print(f"Error creating retriever for images: {e}")
+def run_stages(
+    stages: List[Stage], pool, selected: Optional[Set[str]] = None, max_workers: int = 4
+) -> Dict[str, Dict]:
+    """
+    Run the stages concurrently, each as soon as all its dependencies succeeded.
 
-        cur.execute(f"""SELECT aidb.bulk_embedding('recommend_products');""")
-        vector_time = time.time() - start_time
-        print(
-            f"Creating and refreshing recom_products retriever took {vector_time:.4f} seconds."
-        )
+    A failing stage does not stop independent stages; its dependents are
+    marked as skipped. Stages outside ``selected`` are treated as already
+    succeeded, which is how a rerun of only the failed stages works.
+
+    Returns:
+        dict: stage name -> {"status", "seconds", "error"}
+    """
+    by_name = {stage.name: stage for stage in stages}
+    if selected is None:
+        selected = set(by_name)
+    unknown = selected - set(by_name)
+    if unknown:
+        raise ValueError(f"Unknown setup stage(s): {', '.join(sorted(unknown))}")
+    for stage in stages:
+        missing = set(stage.depends_on) - set(by_name)
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown stage(s): {', '.join(sorted(missing))}")
+
+    results: Dict[str, Dict] = {}
+    status = {name: "succeeded" for name in by_name if name not in selected}
+    pending = [by_name[name] for name in by_name if name in selected]
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for stage in list(pending):
+                dep_status = [status.get(dep) for dep in stage.depends_on]
+                if any(s in ("failed", "skipped") for s in dep_status):
+                    pending.remove(stage)
+                    status[stage.name] = "skipped"
+                    results[stage.name] = {"status": "skipped", "seconds": 0.0, "error": None}
+                    print(f"Stage '{stage.name}' skipped: a dependency did not succeed.")
+                elif all(s == "succeeded" for s in dep_status):
+                    pending.remove(stage)
+                    print(f"Stage '{stage.name}' started.")
+                    running[executor.submit(_run_stage, stage, pool)] = stage
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as error:
+                    status[stage.name] = "failed"
+                    results[stage.name] = {"status": "failed", "seconds": 0.0, "error": str(error)}
+                    print(f"Stage '{stage.name}' failed: {error}")
+                else:
+                    status[stage.name] = "succeeded"
+                    results[stage.name] = {"status": "succeeded", "seconds": seconds, "error": None}
+                    print(f"Stage '{stage.name}' took {seconds:.4f} seconds.")
+    return results
+
+
+def _load_stage_state(path: str) -> Dict[str, Dict]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_stage_state(path: str, results: Dict[str, Dict]) -> None:
+    state = _load_stage_state(path)
+    state.update(results)
+    with open(path, "w") as f:
+        json.dump(state, f, indent=2)
 
 
 def main():
-    conn = None
+    parser = argparse.ArgumentParser(description="Set up the database and knowledge bases.")
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help=f"Rerun only the stages that failed or were skipped in the last run ({SETUP_STATE_FILE}).",
+    )
+    parser.add_argument(
+        "--stages", help="Comma separated list of stages to run, e.g. image_kb,image_embedding."
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Number of stages run at the same time.")
+    args = parser.parse_args()
+
+    stages = build_setup_stages("dataset/updated_stylesc.csv", "dataset/product_reviews.csv")
+    selected = None
+    if args.stages:
+        selected = {name.strip() for name in args.stages.split(",") if name.strip()}
+    elif args.retry_failed:
+        state = _load_stage_state(SETUP_STATE_FILE)
+        selected = {
+            stage.name
+            for stage in stages
+            if state.get(stage.name, {}).get("status") != "succeeded"
+        }
+        if not selected:
+            print("All setup stages already succeeded.")
+            return
+
+    pool = None
     try:
-        conn = create_db_connection()  # Connect to the database
-        conn.autocommit = True  # Enable autocommit for creating the database
+        pool = create_db_pool(1, args.workers)
         start_time = time.time()
-        initialize_database(
-            conn
-        )  # Initialize the db with aidb, pgfs extensions and necessary tables
-        _populate_product_data(
-            conn, "dataset/updated_stylesc.csv"
-        )  # Populate the products table with the stylesc.csv data
-        populate_product_review_data(conn, "dataset/product_reviews.csv")
-        create_and_refresh_retriever(
-            conn
-        )  # Create and refresh the retriever for the products table and images bucket
+        results = run_stages(stages, pool, selected, args.workers)
+        _save_stage_state(SETUP_STATE_FILE, results)
         vector_time = time.time() - start_time
         print(f"Total process time: {vector_time:.4f} seconds.")
+        failed = [name for name, r in results.items() if r["status"] != "succeeded"]
+        if failed:
+            print(
+                f"Stages not completed: {', '.join(failed)}. "
+                "Run again with --retry-failed to rerun only these."
+            )
     except (Exception, psycopg2.DatabaseError) as error:
         print(f"Error: {error}")
     finally:
-        if conn:
-            conn.close()
+        if pool:
+            pool.closeall()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import psycopg2
+
+from typing import Dict, List, Tuple
+from psycopg2 import sql
+
+# Add the parent directory of 'code' to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils.db_connection import create_db_connection
+from connect_encode import (
+    _create_extensions,
+    _create_tables,
+    create_image_knowledge_base,
+    create_review_model,
+    create_text_retriever,
+)
+
+MANIFEST_FILE = "manifest.json"
+SOURCE_TABLES = ["products", "product_review", "product_review_stats"]
+# Knowledge bases and the function registering them without embedding anything
+KNOWLEDGE_BASES = {
+    "recom_images": create_image_knowledge_base,
+    "recommend_products": create_text_retriever,
+}
+
+
+def _table_columns(cur, schema: str, table: str) -> List[str]:
+    cur.execute(
+        """SELECT column_name FROM information_schema.columns
+           WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position;""",
+        (schema, table),
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def _vector_table(cur, knowledge_base: str) -> Tuple[str, str]:
+    """Return (schema, table) holding the embeddings of a knowledge base."""
+    cur.execute(
+        "SELECT vector_schema, vector_table FROM aidb.knowledge_bases WHERE name = %s;",
+        (knowledge_base,),
+    )
+    row = cur.fetchone()
+    if row is None:
+        raise ValueError(f"Knowledge base '{knowledge_base}' does not exist")
+    return row[0], row[1]
+
+
+def _copy_out(cur, schema: str, table: str, columns: List[str], path: str) -> int:
+    """Write a table to a file in the PostgreSQL binary COPY format."""
+    query = sql.SQL("COPY {}.{} ({}) TO STDOUT (FORMAT binary)").format(
+        sql.Identifier(schema), sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, columns))
+    )
+    with open(path, "wb") as f:
+        cur.copy_expert(query, f)
+    return cur.rowcount
+
+
+def _copy_in(cur, schema: str, table: str, columns: List[str], path: str) -> int:
+    """Bulk load a file in the PostgreSQL binary COPY format into a table."""
+    query = sql.SQL("COPY {}.{} ({}) FROM STDIN (FORMAT binary)").format(
+        sql.Identifier(schema), sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, columns))
+    )
+    with open(path, "rb") as f:
+        cur.copy_expert(query, f)
+    return cur.rowcount
+
+
+def export_snapshot(conn: psycopg2.extensions.connection, directory: str) -> Dict:
+    """
+    Snapshot the source tables and the computed embeddings to a directory.
+
+    Every table is written with binary COPY, which keeps the pgvector
+    embeddings as float32 arrays, next to a manifest of their columns.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = {"created": time.time(), "tables": {}, "knowledge_bases": {}}
+    with conn.cursor() as cur:
+        for table in SOURCE_TABLES:
+            start_time = time.time()
+            columns = _table_columns(cur, "public", table)
+            rows = _copy_out(cur, "public", table, columns, os.path.join(directory, f"{table}.bin"))
+            manifest["tables"][table] = {"columns": columns, "rows": rows, "file": f"{table}.bin"}
+            print(f"Exporting {rows} rows of {table} took {time.time() - start_time:.4f} seconds.")
+        for knowledge_base in KNOWLEDGE_BASES:
+            start_time = time.time()
+            schema, table = _vector_table(cur, knowledge_base)
+            columns = _table_columns(cur, schema, table)
+            file_name = f"{knowledge_base}.vectors.bin"
+            rows = _copy_out(cur, schema, table, columns, os.path.join(directory, file_name))
+            manifest["knowledge_bases"][knowledge_base] = {
+                "vector_schema": schema,
+                "vector_table": table,
+                "columns": columns,
+                "rows": rows,
+                "file": file_name,
+            }
+            print(f"Exporting {rows} embeddings of {knowledge_base} took {time.time() - start_time:.4f} seconds.")
+    with open(os.path.join(directory, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def import_snapshot(conn: psycopg2.extensions.connection, directory: str) -> Dict[str, float]:
+    """
+    Restore a snapshot into a fresh database without computing embeddings.
+
+    The source tables are recreated and bulk loaded first, so the live
+    processing of the text knowledge base has nothing to pick up. The
+    knowledge bases are then registered and their vector tables filled
+    with the exported embeddings.
+
+    Returns:
+        dict: step name -> seconds
+    """
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    timings = {}
+    with conn.cursor() as cur:
+        start_time = time.time()
+        _create_extensions(cur)
+        _create_tables(cur)
+        timings["tables"] = time.time() - start_time
+
+        for table, entry in manifest["tables"].items():
+            start_time = time.time()
+            rows = _copy_in(cur, "public", table, entry["columns"], os.path.join(directory, entry["file"]))
+            timings[table] = time.time() - start_time
+            print(f"Loading {rows} rows into {table} took {timings[table]:.4f} seconds.")
+
+        for knowledge_base, entry in manifest["knowledge_bases"].items():
+            start_time = time.time()
+            KNOWLEDGE_BASES[knowledge_base](cur)
+            schema, table = _vector_table(cur, knowledge_base)
+            columns = _table_columns(cur, schema, table)
+            if columns != entry["columns"]:
+                raise ValueError(
+                    f"The vector table of {knowledge_base} has columns {columns}, "
+                    f"the snapshot has {entry['columns']}"
+                )
+            cur.execute(sql.SQL("TRUNCATE {}.{};").format(sql.Identifier(schema), sql.Identifier(table)))
+            rows = _copy_in(cur, schema, table, columns, os.path.join(directory, entry["file"]))
+            timings[knowledge_base] = time.time() - start_time
+            print(f"Restoring {rows} embeddings of {knowledge_base} took {timings[knowledge_base]:.4f} seconds.")
+
+        create_review_model(cur)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or restore products, reviews and knowledge base embeddings.")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("directory", help="Snapshot directory.")
+    args = parser.parse_args()
+
+    conn = None
+    try:
+        conn = create_db_connection()
+        if args.command == "export":
+            # One repeatable read transaction, so all files show the same moment
+            conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+            start_time = time.time()
+            export_snapshot(conn, args.directory)
+            print(f"Total export time: {time.time() - start_time:.4f} seconds.")
+        else:
+            # A failed restore must not leave half loaded tables behind
+            conn.autocommit = False
+            start_time = time.time()
+            import_snapshot(conn, args.directory)
+            conn.commit()
+            print(f"Total restore time: {time.time() - start_time:.4f} seconds.")
+    except (Exception, psycopg2.DatabaseError) as error:
+        if conn and not conn.autocommit:
+            conn.rollback()
+        print(f"Error: {error}")
+    finally:
+        if conn:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+# Add the parent directory of 'code' to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils.db_connection import create_db_pool
+from utils.facets import FacetIndex
+from utils.product_catalog import ProductCatalog
+from utils.query_log import read_query_log
+from utils.search import search_image, search_text
+
+DEFAULT_RETRIEVERS = {"text": "recommend_products", "image": "recom_images"}
+
+
+def _load_image(entry: Dict, image_dir: Optional[str]) -> Optional[bytes]:
+    if not image_dir or "image_sha256" not in entry:
+        return None
+    path = os.path.join(image_dir, entry["image_sha256"])
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _replay_one(entry: Dict, image: Optional[bytes], pool, facets: FacetIndex) -> Tuple[List[str], float]:
+    """Re-execute one logged search on a pooled connection.
+
+    Returns:
+        tuple: result ids and the perf_counter() time the search finished at.
+    """
+    filters = entry.get("filters") or {}
+    selections = filters.get("selections") or {}
+    year_range = tuple(filters["year_range"]) if filters.get("year_range") else None
+    by_reviews = filters.get("by_reviews", False)
+    retriever = entry.get("retriever", DEFAULT_RETRIEVERS[entry["mode"]])
+    conn = pool.getconn()
+    try:
+        conn.autocommit = True
+        if entry["mode"] == "text":
+            result_ids = search_text(
+                conn, facets, retriever, entry["query"], entry["k"], selections, year_range, by_reviews
+            )
+        else:
+            result_ids = search_image(conn, facets, retriever, image, entry["k"], selections, year_range, by_reviews)
+        return result_ids, time.perf_counter()
+    finally:
+        pool.putconn(conn)
+
+
+def _overlap(logged: List[str], replayed: List[str]) -> float:
+    if not logged and not replayed:
+        return 1.0
+    return len(set(logged) & set(replayed)) / len(set(logged) | set(replayed))
+
+
+def replay(
+    entries: List[Dict], pool, facets: FacetIndex, concurrency: int, rate: float, image_dir: Optional[str]
+) -> Dict:
+    """
+    Re-execute logged searches and measure them.
+
+    Searches arrive on an open-loop schedule: one every 1/rate seconds, or all
+    at once when rate is 0. Latency is measured from the scheduled arrival, so
+    time spent waiting for a free worker is included.
+    """
+    runnable = []
+    skipped = 0
+    for entry in entries:
+        image = _load_image(entry, image_dir) if entry["mode"] == "image" else None
+        if entry["mode"] == "image" and image is None:
+            skipped += 1
+            continue
+        runnable.append((entry, image))
+
+    latencies = []
+    overlaps = []
+    exact = 0
+    errors = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for i, (entry, image) in enumerate(runnable):
+            arrival = start + (i / rate if rate > 0 else 0.0)
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append((entry, arrival, executor.submit(_replay_one, entry, image, pool, facets)))
+        for entry, arrival, future in futures:
+            try:
+                result_ids, finished = future.result()
+            except Exception as e:
+                errors += 1
+                print(f"Replay of a {entry['mode']} search failed: {e}")
+                continue
+            latencies.append(finished - arrival)
+            overlaps.append(_overlap(entry["result_ids"], result_ids))
+            exact += result_ids == entry["result_ids"]
+    elapsed = time.perf_counter() - start
+
+    completed = len(latencies)
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        "replayed": completed,
+        "errors": errors,
+        "skipped_images": skipped,
+        "seconds": elapsed,
+        "throughput_qps": completed / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "max_ms": float(latencies_ms.max()),
+        "mean_overlap": float(np.mean(overlaps)) if overlaps else 0.0,
+        "exact_match_ratio": exact / completed if completed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a search query log against a database.")
+    parser.add_argument("log", help="Query log file written with QUERY_LOG_PATH set.")
+    parser.add_argument("--dsn", help="Target database, defaults to the DB_* settings.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of searches run at the same time.")
+    parser.add_argument("--rate", type=float, default=0.0, help="Arrival rate in searches per second, 0 for no pacing.")
+    parser.add_argument("--image-dir", help="Directory of logged images (QUERY_LOG_IMAGE_DIR).")
+    parser.add_argument("--limit", type=int, help="Replay only the first N entries.")
+    args = parser.parse_args()
+
+    entries = read_query_log(args.log)[: args.limit]
+    pool = create_db_pool(1, args.concurrency, args.dsn)
+    try:
+        conn = pool.getconn()
+        try:
+            catalog = ProductCatalog.load(conn)
+        finally:
+            pool.putconn(conn)
+        report = replay(entries, pool, FacetIndex(catalog), args.concurrency, args.rate, args.image_dir)
+    finally:
+        pool.closeall()
+
+    print(f"Replayed {report['replayed']} searches in {report['seconds']:.4f} seconds "
+          f"({report['errors']} errors, {report['skipped_images']} image searches without a logged image).")
+    print(f"Throughput: {report['throughput_qps']:.2f} searches/second")
+    print(f"Latency ms: p50 {report['p50_ms']:.1f}, p95 {report['p95_ms']:.1f}, "
+          f"p99 {report['p99_ms']:.1f}, max {report['max_ms']:.1f}")
+    print(f"Result drift: mean overlap {report['mean_overlap']:.3f}, "
+          f"identical results {report['exact_match_ratio']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,14 @@
 # pages/review_page.py
 import streamlit as st
 import os
-import io
-import boto3
 import pandas as pd 
 import re         
-from PIL import Image
-from botocore.handlers import disable_signing
-from sqlalchemy import create_engine, text
-from urllib.parse import quote_plus
-import psycopg2 
 import streamlit_antd_components as sac
-
-def create_db_connection():
-    conn = psycopg2.connect(
-    dbname=os.getenv("DB_NAME"),
-    user=os.getenv("DB_USER"),
-    host=os.getenv("DB_HOST"),
-    port=os.getenv("DB_PORT"),
-)
-    return conn
-
-# Reuse or redefine necessary functions/engine
-DATABASE_URL = "postgresql://%s@%s:%s/%s" % (os.getenv("DB_USER"), os.getenv("DB_HOST"), os.getenv("DB_PORT"), os.getenv("DB_NAME"))
-
-# Create engine within the page scope (or import from a utils file)
-try:
-    engine = create_engine(DATABASE_URL)
-except Exception as e:
-    st.error(f"Failed to create database engine: {e}")
-    st.stop() # Stop execution if DB connection fails
-
-if "db_conn" not in st.session_state or st.session_state.db_conn.closed:
-    st.session_state.db_conn = create_db_connection()
+from utils import queries
+from utils.admission import Overloaded, admit
+from utils.image_store import fetch_image
+from utils.db_connection import primary_connection, run_read
+from utils.review_stats import record_review
 
 # --- Caching Functions ---
 @st.cache_data # Cache the CSV reading
@@ -48,9 +24,8 @@ def load_reviews_data(csv_path):
         return None
 
 # Cache the results of summary and label generation for a given product ID
-# The _engine argument isn't used directly but forces rerun if engine changes (though unlikely here)
 @st.cache_data(show_spinner="Generating review summary and labels...")
-def get_summary_and_labels(_engine, review_string):
+def get_summary_and_labels(review_string):
     """Generates summary and labels using AIDB via SQL"""
     summary_text = None
     final_labels = []
@@ -64,17 +39,13 @@ def get_summary_and_labels(_engine, review_string):
 
     Reviews:
     {review_string}"""
-    query_summary = "SELECT decode_text FROM aidb.decode_text(%s, %s);"
 
     try:
-        conn = st.session_state.db_conn
-        with conn.cursor() as cur: # Use the passed engine
+        # Model calls stay on the primary, replicas only serve plain reads
+        with admit("llm"), primary_connection() as conn:
             # Execute Summary Query
-            
-            cur.execute(query_summary, (model_name, summary_prompt,))
-            result_summary = cur.fetchone()
-            if result_summary and result_summary[0]:
-                raw_output = result_summary[0]
+            raw_output = queries.decode_text(conn, model_name, summary_prompt)
+            if raw_output:
                 # Clean the summary
                 summary_text = re.sub(r"^Here is the summary:?\s*", "", raw_output, flags=re.IGNORECASE).strip()
                 summary_text = summary_text.strip('```json').strip('```').strip() # Remove markdown fences
@@ -85,13 +56,9 @@ def get_summary_and_labels(_engine, review_string):
 
                     Summary:
                     {summary_text}"""
-                    query_labels = "SELECT decode_text FROM aidb.decode_text(%s, %s);"
-
-                    cur.execute(query_labels, (model_name, label_prompt,))
-                    result_labels = cur.fetchone()
 
-                    if result_labels and result_labels[0]:
-                        raw_labels_output = result_labels[0]
+                    raw_labels_output = queries.decode_text(conn, model_name, label_prompt)
+                    if raw_labels_output:
                         # Clean the labels
                         labels_string = raw_labels_output.strip()
                         labels_string = re.sub(r"^Here are the labels:?\s*", "", labels_string, flags=re.IGNORECASE).strip()
@@ -105,6 +72,9 @@ def get_summary_and_labels(_engine, review_string):
             else:
                 st.warning("Failed to generate summary from the reviews.")
 
+    except Overloaded:
+        # Not cached, the caller answers with an earlier summary
+        raise
     except Exception as e:
         st.error(f"An error occurred during AI processing: {e}")
         # Optionally: Log the specific prompt that failed for debugging
@@ -113,39 +83,71 @@ def get_summary_and_labels(_engine, review_string):
     return summary_text, final_labels
 
 
+@st.cache_resource
+def _last_summaries():
+    """Latest summary and labels per product, shared by all sessions."""
+    return {}
+
+
+def summarize_reviews(product_id, review_string):
+    """
+    Return the summary and labels of a product's reviews.
+
+    When the completions model is saturated the last summary generated for
+    the product is returned instead, even if reviews were added since.
+    """
+    try:
+        summary, labels = get_summary_and_labels(review_string)
+    except Overloaded:
+        stale = _last_summaries().get(product_id)
+        if stale:
+            st.info("The summary service is busy, showing an earlier summary of the reviews.")
+            return stale
+        st.info("The summary service is busy, please try again in a moment.")
+        return None, []
+    if summary:
+        _last_summaries()[product_id] = (summary, labels)
+    return summary, labels
+
+
 @st.cache_data
 def get_product_details_by_id(img_id):
     """ Fetch product details for a given image ID. """
-    query = text("SELECT productDisplayName, product_idFROM products WHERE product_id= :img_id;")
-    # Use the globally defined engine
     try:
-        with engine.connect() as connection:
-            result = connection.execute(query, {"img_id": img_id})
-            product = result.mappings().first()
-            if product:
-                return {
-                    "name": product["productdisplayname"],
-                    "img_id": product["img_id"],
-                }
-            else:
-                return None
+        product = run_read(lambda conn: queries.product_by_id(conn, img_id))
+        if product:
+            return {
+                "name": product[0],
+                "img_id": product[1],
+            }
+        else:
+            return None
     except Exception as e:
         st.error(f"Database error fetching product details: {e}")
         return None
 
+
+def get_reviews(product_id):
+    """ Fetch the reviews of a product as a DataFrame. """
+    rows = run_read(lambda conn: queries.reviews_for_product(conn, product_id))
+    return pd.DataFrame(rows, columns=queries.REVIEW_COLUMNS)
+
+def get_review_stats(product_id):
+    """ Fetch the precomputed review stats of a product as a dict, or None. """
+    row = run_read(lambda conn: queries.review_stats(conn, product_id))
+    return dict(zip(queries.REVIEW_STATS_COLUMNS, row)) if row else None
+
+
+def save_review(product_id, rating, review_text, user_id="guest"):
+    """ Store a review and fold it into the review stats of the product. """
+    with primary_connection() as conn:
+        record_review(conn, user_id, product_id, rating, review_text)
+
+
 def display_image_s3(image_name_with_extension, caption="", width=200, staging_bucket='public-ai-images'):
     """ Displays an image fetched directly from S3. """
     try:
-        s3 = boto3.resource(
-            service_name="s3",
-            endpoint_url='http://s3.eu-central-1.amazonaws.com', # Make sure this endpoint is correct
-        )
-        s3.meta.client.meta.events.register("choose-signer.s3.*", disable_signing)
-        bucket = s3.Bucket(staging_bucket)
-        obj = bucket.Object(image_name_with_extension)
-        response = obj.get()
-        image_data = response['Body'].read()
-        image = Image.open(io.BytesIO(image_data))
+        image = fetch_image(image_name_with_extension, staging_bucket)
         st.image(image, caption=caption if caption else image_name_with_extension, width=width)
         return True
     except Exception as e:
@@ -184,18 +186,22 @@ if review_item_id:
         # --- Load Reviews and Generate Summary/Labels ---
         if item_id is not None: # Proceed only if ID conversion was successful
             try:
-                with engine.connect() as connection:
-                    query = text("SELECT * FROM product_review WHERE product_id = :item_id;")
-                    result = connection.execute(query, {"item_id": str(item_id)})
-                filtered_reviews = result.mappings().all()
-                # Convert to DataFrame for easier manipulation
-                filtered_reviews = pd.DataFrame(filtered_reviews)
+                filtered_reviews = get_reviews(str(item_id))
                 if not filtered_reviews.empty and 'review' in filtered_reviews.columns:
                     
                     review_list = filtered_reviews["review"].dropna().tolist()
                     review_string = "\n".join(review_list)
                     # Get summary and labels using the cached function
-                    summary, labels = get_summary_and_labels(engine, review_string) # Pass engine and ID
+                    summary, labels = summarize_reviews(item_id_str, review_string)
+                    stats = get_review_stats(str(item_id))
+                    if stats and stats["review_count"]:
+                        trend = stats["rating_trend"] or 0.0
+                        st.markdown(
+                            f"**Average rating:** {stats['rating_mean']:.1f} Stars "
+                            f"from {stats['review_count']} review(s), "
+                            f"recent reviews {'+' if trend >= 0 else ''}{trend:.1f}, "
+                            f"sentiment {stats['sentiment_mean']:+.2f}"
+                        )
                     # Display Summary
                     st.subheader("Review Summary")
                     if summary:
@@ -250,10 +256,15 @@ if review_item_id:
         review_text = st.text_area("Write your review:", height=150)
 
         if st.button("Submit Review"):
-            # Placeholder for saving the review (same as before)
-            st.success(f"Thank you for reviewing '{product_details['name']}'!")
-            st.balloons()
-            # Optionally clear state/redirect
+            if not review_text.strip():
+                st.warning("Please write a review before submitting.")
+            else:
+                try:
+                    save_review(item_id_str, rating, review_text)
+                    st.success(f"Thank you for reviewing '{product_details['name']}'!")
+                    st.balloons()
+                except Exception as e:
+                    st.error(f"Could not save your review: {e}")
 
     else:
         st.error(f"Could not load details for product ID: {item_id_str}")
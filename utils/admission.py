@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default limits per resource: (concurrent calls, waiting calls, seconds to wait).
+# Each value can be overridden with ADMISSION_<RESOURCE>_CONCURRENCY,
+# ADMISSION_<RESOURCE>_QUEUE and ADMISSION_<RESOURCE>_TIMEOUT.
+DEFAULT_LIMITS = {
+    # Completions model behind aidb.decode_text
+    "llm": (2, 4, 10.0),
+    # CLIP embedding of an uploaded image
+    "image_search": (4, 8, 2.0),
+    # Text embedding and retrieval
+    "text_search": (8, 16, 1.0),
+}
+
+
+class Overloaded(Exception):
+    """Raised when a call is not admitted to a saturated resource."""
+
+    def __init__(self, resource, reason):
+        super().__init__(f"{resource} is overloaded ({reason})")
+        self.resource = resource
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Concurrency limit with a bounded wait queue for one resource.
+
+    At most ``max_concurrent`` calls run at the same time and at most
+    ``max_queue`` wait for a slot. A call arriving at a full queue is shed
+    at once, a waiting call gives up after ``timeout`` seconds; both raise
+    Overloaded so the caller can answer with a degraded response.
+    """
+
+    def __init__(self, name, max_concurrent, max_queue, timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._admitted = 0
+        self._queued = 0
+        self._rejected = {"queue_full": 0, "timeout": 0}
+        self._wait_seconds = 0.0
+
+    @contextmanager
+    def admit(self):
+        """
+        Hold a slot of the resource for the duration of the block.
+
+        Yields:
+            bool: True when the call had to wait, i.e. the resource is
+            congested and a cheaper variant of the work is advisable.
+        """
+        start = time.monotonic()
+        with self._condition:
+            waited = self._active >= self.max_concurrent or self._waiting > 0
+            if waited:
+                if self._waiting >= self.max_queue:
+                    self._rejected["queue_full"] += 1
+                    raise Overloaded(self.name, "queue full")
+                self._waiting += 1
+                self._queued += 1
+                deadline = start + self.timeout
+                try:
+                    while self._active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._rejected["timeout"] += 1
+                            raise Overloaded(self.name, "timeout")
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._active += 1
+            self._admitted += 1
+            self._wait_seconds += time.monotonic() - start
+        try:
+            yield waited
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify()
+
+    def metrics(self):
+        with self._condition:
+            return {
+                "active": self._active,
+                "waiting": self._waiting,
+                "admitted": self._admitted,
+                "queued": self._queued,
+                "rejected_queue_full": self._rejected["queue_full"],
+                "rejected_timeout": self._rejected["timeout"],
+                "wait_seconds": self._wait_seconds,
+            }
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def controller(resource):
+    """Return the process wide admission controller of a resource."""
+    with _controllers_lock:
+        if resource not in _controllers:
+            concurrency, queue, timeout = DEFAULT_LIMITS[resource]
+            prefix = f"ADMISSION_{resource.upper()}_"
+            _controllers[resource] = AdmissionController(
+                resource,
+                int(os.getenv(prefix + "CONCURRENCY", concurrency)),
+                int(os.getenv(prefix + "QUEUE", queue)),
+                float(os.getenv(prefix + "TIMEOUT", timeout)),
+            )
+        return _controllers[resource]
+
+
+def admit(resource):
+    """Context manager holding a slot of a resource, see AdmissionController.admit."""
+    return controller(resource).admit()
+
+
+def all_metrics():
+    """Return the metrics of every resource used so far."""
+    with _controllers_lock:
+        controllers = list(_controllers.values())
+    return {c.name: c.metrics() for c in controllers}
+
+
+def metrics_text():
+    """Return the metrics in the Prometheus text exposition format."""
+    lines = [
+        "# TYPE admission_active gauge",
+        "# TYPE admission_queue_depth gauge",
+        "# TYPE admission_admitted_total counter",
+        "# TYPE admission_queued_total counter",
+        "# TYPE admission_rejected_total counter",
+        "# TYPE admission_wait_seconds_total counter",
+    ]
+    for name, m in sorted(all_metrics().items()):
+        lines.append(f'admission_active{{resource="{name}"}} {m["active"]}')
+        lines.append(f'admission_queue_depth{{resource="{name}"}} {m["waiting"]}')
+        lines.append(f'admission_admitted_total{{resource="{name}"}} {m["admitted"]}')
+        lines.append(f'admission_queued_total{{resource="{name}"}} {m["queued"]}')
+        lines.append(f'admission_rejected_total{{resource="{name}",reason="queue_full"}} {m["rejected_queue_full"]}')
+        lines.append(f'admission_rejected_total{{resource="{name}",reason="timeout"}} {m["rejected_timeout"]}')
+        lines.append(f'admission_wait_seconds_total{{resource="{name}"}} {m["wait_seconds"]:.6f}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+
+
+def start_metrics_server():
+    """Serve metrics_text() over HTTP on ADMISSION_METRICS_PORT, once per process."""
+    global _metrics_server
+    port = os.getenv("ADMISSION_METRICS_PORT")
+    with _controllers_lock:
+        if not port or _metrics_server is not None:
+            return
+        _metrics_server = ThreadingHTTPServer(("", int(port)), _MetricsHandler)
+    threading.Thread(target=_metrics_server.serve_forever, name="admission-metrics", daemon=True).start()
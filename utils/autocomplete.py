@@ -0,0 +1,149 @@
+import bisect
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+# Vocabularies offered as suggestions next to the product names
+SUGGESTION_COLUMNS = ("mastercategory", "subcategory", "articletype", "basecolour")
+
+# Top suggestions of prefixes up to this length are computed when building,
+# the ranges of such short prefixes cover a large part of the index
+SHORT_PREFIX_LENGTH = 2
+
+# Number of suggestions kept per precomputed prefix
+MAX_SUGGESTIONS = 10
+
+# The delta index is merged into the main one when it reaches this fraction
+COMPACT_RATIO = 0.1
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text):
+    """Lower case a phrase and collapse its whitespace."""
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+
+class _PrefixIndex:
+    """Immutable sorted array of phrases with their popularity weights."""
+
+    def __init__(self, weighted_phrases, precompute=True):
+        """
+        Args:
+            weighted_phrases (dict): normalized phrase -> (display text, weight)
+            precompute (bool): compute the top suggestions of short prefixes.
+        """
+        self.terms = sorted(weighted_phrases)
+        self.displays = [weighted_phrases[t][0] for t in self.terms]
+        self.weights = np.array([weighted_phrases[t][1] for t in self.terms], dtype=np.int64)
+        self._short_tops = {}
+        if precompute:
+            prefixes = {t[:n] for t in self.terms for n in range(1, SHORT_PREFIX_LENGTH + 1)}
+            for prefix in prefixes:
+                self._short_tops[prefix] = self._top(prefix, MAX_SUGGESTIONS)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\uffff", lo=start)
+        return start, end
+
+    def _top(self, prefix, k):
+        start, end = self._range(prefix)
+        if end - start <= k:
+            indices = np.arange(start, end)
+        else:
+            indices = start + np.argpartition(-self.weights[start:end], k - 1)[:k]
+        return sorted(indices.tolist(), key=lambda i: -self.weights[i])
+
+    def top(self, prefix, k):
+        """Return the indices of the k heaviest phrases starting with prefix."""
+        if k <= MAX_SUGGESTIONS and self._short_tops and len(prefix) <= SHORT_PREFIX_LENGTH:
+            return self._short_tops.get(prefix, [])[:k]
+        return self._top(prefix, k)
+
+
+class Autocomplete:
+    """
+    Popularity weighted type-ahead suggestions over product names and
+    category vocabularies.
+
+    Phrases are kept in a sorted array and a prefix is resolved with two binary
+    searches. The heaviest phrases of the range are picked with argpartition,
+    and precomputed for one and two character prefixes whose ranges are the
+    largest. A phrase weighs the number of products carrying it.
+
+    Products added to the catalog go to a small delta index, queried together
+    with the main one, which is merged in once it grows past COMPACT_RATIO of
+    the main index. A merge rebuilds from the current catalog, which also
+    drops the names of deleted products.
+    """
+
+    def __init__(self, catalog):
+        self._lock = threading.Lock()
+        self._build(catalog)
+
+    def _build(self, catalog):
+        self._main = _PrefixIndex(self._catalog_phrases(catalog))
+        self._delta = _PrefixIndex({}, precompute=False)
+        self._delta_phrases = {}
+        self._ids = catalog.ids
+
+    @staticmethod
+    def _name_phrases(catalog, rows):
+        displays = {}
+        weights = Counter()
+        for row in rows:
+            name = catalog.name(row)
+            term = normalize(name)
+            if term:
+                displays.setdefault(term, name)
+                weights[term] += 1
+        return {term: (displays[term], weight) for term, weight in weights.items()}
+
+    def _catalog_phrases(self, catalog):
+        phrases = self._name_phrases(catalog, range(len(catalog)))
+        for column in SUGGESTION_COLUMNS:
+            vocabulary = catalog.vocabularies[column]
+            counts = np.bincount(catalog.codes(column), minlength=len(vocabulary))
+            for value, count in zip(vocabulary, counts):
+                term = normalize(value)
+                if term:
+                    display, weight = phrases.get(term, (value, 0))
+                    phrases[term] = (display, weight + int(count))
+        return phrases
+
+    def update_from_catalog(self, catalog):
+        """Add the products of a refreshed catalog that were not indexed yet."""
+        with self._lock:
+            if catalog.ids is self._ids:
+                return
+            new_rows = np.flatnonzero(~np.isin(catalog.ids, self._ids))
+            self._ids = catalog.ids
+            if len(new_rows) == 0:
+                return
+            for term, (display, weight) in self._name_phrases(catalog, new_rows).items():
+                _, old_weight = self._delta_phrases.get(term, (display, 0))
+                self._delta_phrases[term] = (display, old_weight + weight)
+            if len(self._delta_phrases) > COMPACT_RATIO * max(len(self._main), 1):
+                self._build(catalog)
+            else:
+                self._delta = _PrefixIndex(self._delta_phrases, precompute=False)
+
+    def suggest(self, prefix, k=8):
+        """Return up to k suggestions for a typed prefix, most popular first."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        main, delta = self._main, self._delta
+        merged = {}
+        for index in (main, delta):
+            for i in index.top(prefix, k):
+                display, weight = merged.get(index.terms[i], (index.displays[i], 0))
+                merged[index.terms[i]] = (display, weight + int(index.weights[i]))
+        ranked = sorted(merged.values(), key=lambda item: -item[1])
+        return [display for display, _ in ranked[:k]]
@@ -1,17 +1,323 @@
 import psycopg2
 import os
+import threading
+import time
+from contextlib import contextmanager
+from psycopg2.extensions import make_dsn, parse_dsn
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 from dotenv import load_dotenv
 
+from utils.admission import DEFAULT_LIMITS
+
 # Load environment variables from .env file
 load_dotenv()
 
+
+def _connection_params():
+    """Return the primary connection keyword arguments read from the environment.
+
+    DB_PRIMARY_DSN takes precedence over the individual DB_* settings.
+    """
+    primary_dsn = os.getenv("DB_PRIMARY_DSN")
+    if primary_dsn:
+        return dict(dsn=primary_dsn)
+    return dict(
+        dbname=os.getenv("DB_NAME"),
+        password=os.getenv("DB_PASSWORD"),
+        user=os.getenv("DB_USER"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+    )
+
+
 def create_db_connection():
-    """Create and return a database connection."""
-    conn = psycopg2.connect(
-    dbname=os.getenv("DB_NAME"),
-    password=os.getenv("DB_PASSWORD"),
-    user=os.getenv("DB_USER"),
-    host=os.getenv("DB_HOST"),
-    port=os.getenv("DB_PORT"),
-)
-    return conn
\ No newline at end of file
+    """Create and return a database connection to the primary."""
+    conn = psycopg2.connect(**_connection_params())
+    return conn
+
+
+def create_db_pool(minconn=1, maxconn=4, dsn=None):
+    """Create and return a thread-safe pool of database connections.
+
+    The pool connects to ``dsn`` when given, otherwise to the primary.
+    """
+    if dsn:
+        return ThreadedConnectionPool(minconn, maxconn, dsn=dsn)
+    return ThreadedConnectionPool(minconn, maxconn, **_connection_params())
+
+
+def _with_connect_timeout(dsn, seconds):
+    """Return the DSN with a connect_timeout, unless it already sets one."""
+    if "connect_timeout" in parse_dsn(dsn):
+        return dsn
+    return make_dsn(dsn, connect_timeout=seconds)
+
+
+def _default_maxconn():
+    """Connections per server: enough for every admitted search at once, plus a few for the rest."""
+    admitted = sum(
+        int(os.getenv(f"ADMISSION_{resource.upper()}_CONCURRENCY", concurrency))
+        for resource, (concurrency, _, _) in DEFAULT_LIMITS.items()
+    )
+    return admitted + 4
+
+
+class BlockingPool:
+    """
+    Thread-safe connection pool whose getconn() waits for a free connection.
+
+    ThreadedConnectionPool raises PoolError as soon as all its connections
+    are lent out; this one waits up to ``timeout`` seconds first.
+    """
+
+    def __init__(self, maxconn, timeout=5.0, **connect_kwargs):
+        self._pool = ThreadedConnectionPool(0, maxconn, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError("connection pool exhausted")
+        try:
+            return self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+def _lsn_to_int(lsn):
+    """Convert a WAL location such as '16/B374D848' to a byte position."""
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class ReplicaRouter:
+    """
+    Route read-only queries to streaming replicas and everything else to the primary.
+
+    Replicas are used round-robin among the healthy ones. A replica is healthy
+    when it is reachable, in recovery, and its replay is not behind the
+    primary by more than ``max_lag_bytes`` of WAL or ``max_lag_seconds``. The
+    health of every replica is checked every ``health_interval`` seconds on a
+    background thread, and a replica whose connection fails is taken out
+    until the next check. Reads fall back to the primary when no replica is
+    healthy, or when the pool of a replica has no free connection within
+    ``pool_timeout`` seconds.
+    """
+
+    def __init__(
+        self,
+        replica_dsns,
+        health_interval=5.0,
+        max_lag_bytes=16 * 1024 * 1024,
+        max_lag_seconds=30.0,
+        maxconn=None,
+        pool_timeout=5.0,
+        connect_timeout=5,
+    ):
+        self.replica_dsns = list(replica_dsns)
+        self.health_interval = health_interval
+        self.max_lag_bytes = max_lag_bytes
+        self.max_lag_seconds = max_lag_seconds
+        maxconn = maxconn or _default_maxconn()
+        self._primary_pool = BlockingPool(maxconn, pool_timeout, **_connection_params())
+        # An unreachable replica must not hold a health check or a search for long
+        self._replica_pools = {
+            dsn: BlockingPool(maxconn, pool_timeout, dsn=_with_connect_timeout(dsn, connect_timeout))
+            for dsn in self.replica_dsns
+        }
+        self._healthy = list(self.replica_dsns)
+        self._status = {}
+        self._checked_at = 0.0
+        self._next = 0
+        self._lock = threading.Lock()
+        self._health_lock = threading.Lock()
+
+    def _primary_lsn(self):
+        conn = self._primary_pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_current_wal_lsn()::text;")
+                return _lsn_to_int(cur.fetchone()[0])
+        finally:
+            self._primary_pool.putconn(conn, close=bool(conn.closed))
+
+    def _replica_status(self, dsn, primary_lsn):
+        pool = self._replica_pools[dsn]
+        conn = pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT pg_is_in_recovery(),
+                              pg_last_wal_replay_lsn()::text,
+                              EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp());"""
+                )
+                in_recovery, replay_lsn, replay_age = cur.fetchone()
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+        lag_bytes = None
+        if primary_lsn is not None and replay_lsn is not None:
+            lag_bytes = max(primary_lsn - _lsn_to_int(replay_lsn), 0)
+        # The age of the last replayed transaction only means lag while
+        # there is WAL left to replay, an idle primary makes it grow too
+        behind = lag_bytes is None or lag_bytes > 0
+        healthy = bool(in_recovery) and (lag_bytes is None or lag_bytes <= self.max_lag_bytes)
+        if behind and replay_age is not None and replay_age > self.max_lag_seconds:
+            healthy = False
+        return {"healthy": healthy, "lag_bytes": lag_bytes, "replay_age_seconds": replay_age}
+
+    def check_health(self):
+        """Refresh the health of every replica and return their status."""
+        try:
+            primary_lsn = self._primary_lsn()
+        except psycopg2.Error:
+            primary_lsn = None
+        previous = self.status()
+        status = {}
+        for dsn in self.replica_dsns:
+            try:
+                status[dsn] = self._replica_status(dsn, primary_lsn)
+            except PoolError:
+                # Every connection is busy with searches: the replica is loaded, not down
+                status[dsn] = previous.get(dsn, {"healthy": dsn in self._healthy})
+            except psycopg2.Error as e:
+                status[dsn] = {"healthy": False, "error": str(e)}
+        with self._lock:
+            self._status = status
+            self._healthy = [dsn for dsn in self.replica_dsns if status[dsn]["healthy"]]
+            self._checked_at = time.monotonic()
+        return status
+
+    def _start_health_check(self):
+        """Check the replicas on a background thread, unless a check is already running."""
+        if not self._health_lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.check_health()
+            finally:
+                self._health_lock.release()
+
+        threading.Thread(target=run, name="replica-health", daemon=True).start()
+
+    def status(self):
+        """Return the last health check result of every replica."""
+        with self._lock:
+            return dict(self._status)
+
+    def _read_candidates(self):
+        """Return the pools to try for a read: healthy replicas round-robin, then the primary."""
+        if self.replica_dsns and time.monotonic() - self._checked_at >= self.health_interval:
+            self._start_health_check()
+        with self._lock:
+            healthy = list(self._healthy)
+            start = self._next
+            self._next += 1
+        if healthy:
+            start %= len(healthy)
+            healthy = healthy[start:] + healthy[:start]
+        return [(dsn, self._replica_pools[dsn]) for dsn in healthy] + [(None, self._primary_pool)]
+
+    def _mark_down(self, dsn):
+        if dsn is None:
+            return
+        with self._lock:
+            if dsn in self._healthy:
+                self._healthy.remove(dsn)
+
+    def run_read(self, func):
+        """
+        Run ``func(conn)`` on a read-only connection and return its result.
+
+        When the connection turns out to be broken the call is retried on the
+        next healthy replica, and finally on the primary. So is it when the
+        pool of a server has no free connection in time.
+        """
+        last_error = None
+        for dsn, pool in self._read_candidates():
+            try:
+                conn = pool.getconn()
+            except PoolError as e:
+                last_error = e
+                continue
+            except psycopg2.OperationalError as e:
+                self._mark_down(dsn)
+                last_error = e
+                continue
+            try:
+                conn.set_session(readonly=True, autocommit=True)
+                result = func(conn)
+            except psycopg2.OperationalError as e:
+                if not conn.closed:
+                    pool.putconn(conn)
+                    raise
+                # Lost the server, try the next one
+                pool.putconn(conn, close=True)
+                self._mark_down(dsn)
+                last_error = e
+                continue
+            except Exception:
+                pool.putconn(conn, close=bool(conn.closed))
+                raise
+            pool.putconn(conn)
+            return result
+        raise last_error or psycopg2.OperationalError("No database server available for reads")
+
+    @contextmanager
+    def primary_connection(self):
+        """Lend an autocommit connection to the primary."""
+        conn = self._primary_pool.getconn()
+        try:
+            conn.set_session(readonly=False, autocommit=True)
+            yield conn
+        finally:
+            self._primary_pool.putconn(conn, close=bool(conn.closed))
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """Return the process wide router built from DB_REPLICA_DSNS.
+
+    DB_REPLICA_DSNS is a comma separated list of replica connection strings.
+    Without it every read goes to the primary. DB_POOL_MAXCONN sets the
+    connections per server, by default the sum of the admission limits plus
+    a few, and DB_POOL_TIMEOUT how long to wait for a free one.
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            replica_dsns = [dsn.strip() for dsn in os.getenv("DB_REPLICA_DSNS", "").split(",") if dsn.strip()]
+            _router = ReplicaRouter(
+                replica_dsns,
+                max_lag_bytes=int(os.getenv("DB_MAX_REPLICA_LAG_BYTES", 16 * 1024 * 1024)),
+                max_lag_seconds=float(os.getenv("DB_MAX_REPLICA_LAG_SECONDS", 30)),
+                maxconn=int(os.getenv("DB_POOL_MAXCONN", 0)) or None,
+                pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 5)),
+                connect_timeout=int(os.getenv("DB_CONNECT_TIMEOUT", 5)),
+            )
+        return _router
+
+
+def run_read(func):
+    """Run ``func(conn)`` on a replica, or on the primary when none is available."""
+    return get_router().run_read(func)
+
+
+def primary_connection():
+    """Context manager lending an autocommit connection to the primary."""
+    return get_router().primary_connection()
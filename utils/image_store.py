@@ -0,0 +1,55 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import boto3
+from botocore.config import Config
+from botocore.handlers import disable_signing
+from PIL import Image
+
+IMAGE_BUCKET = "public-ai-images"
+S3_ENDPOINT = "http://s3.eu-central-1.amazonaws.com"
+
+# Concurrent image downloads shared by all sessions of the process
+MAX_FETCH_WORKERS = 16
+
+_client = None
+_client_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS, thread_name_prefix="image-fetch")
+
+
+def _s3_client():
+    """Return the process wide anonymous S3 client, clients are thread-safe."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = boto3.client(
+                "s3",
+                endpoint_url=S3_ENDPOINT,
+                config=Config(max_pool_connections=MAX_FETCH_WORKERS),
+            )
+            _client.meta.events.register("choose-signer.s3.*", disable_signing)
+        return _client
+
+
+def fetch_image(image_name, bucket=IMAGE_BUCKET):
+    """Download and decode one image of the bucket."""
+    response = _s3_client().get_object(Bucket=bucket, Key=image_name)
+    image = Image.open(io.BytesIO(response["Body"].read()))
+    image.load()
+    return image
+
+
+def fetch_images(image_names, bucket=IMAGE_BUCKET):
+    """
+    Download images concurrently, yielding them as they complete.
+
+    Yields:
+        tuple: (image name, PIL image or None, exception or None)
+    """
+    futures = {_executor.submit(fetch_image, name, bucket): name for name in image_names}
+    for future in as_completed(futures):
+        try:
+            yield futures[future], future.result(), None
+        except Exception as e:
+            yield futures[future], None, e
@@ -0,0 +1,242 @@
+import threading
+import time
+
+import numpy as np
+
+# Categorical product attributes kept as integer codes.
+# Postgres folds the unquoted column names of the products table to lower case.
+CATEGORICAL_COLUMNS = (
+    "gender",
+    "mastercategory",
+    "subcategory",
+    "articletype",
+    "basecolour",
+    "season",
+    "usage",
+)
+
+# Stored in the year array for products without a year
+YEAR_MISSING = 0
+
+CATALOG_QUERY = (
+    "SELECT product_id, "
+    + ", ".join(CATEGORICAL_COLUMNS)
+    + ", year, productdisplayname FROM products;"
+)
+
+# Changes whenever products is recreated or rows are inserted, updated or deleted.
+# The statistics counters are flushed asynchronously, so a change can take a
+# moment to show up. Clearing the snapshot keeps the counters fresh inside an
+# open transaction.
+FINGERPRINT_QUERY = """
+    SELECT pg_stat_clear_snapshot();
+    SELECT c.oid::bigint,
+           COALESCE(s.n_tup_ins, 0) + COALESCE(s.n_tup_upd, 0) + COALESCE(s.n_tup_del, 0)
+    FROM pg_class c
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.oid = to_regclass('products');
+"""
+
+
+def _smallest_code_dtype(n_values):
+    if n_values <= np.iinfo(np.uint8).max + 1:
+        return np.uint8
+    if n_values <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    return np.uint32
+
+
+def catalog_fingerprint(conn):
+    """Return a cheap value that changes when the products table changes."""
+    with conn.cursor() as cur:
+        cur.execute(FINGERPRINT_QUERY)
+        return cur.fetchone()
+
+
+class ProductCatalog:
+    """
+    Columnar, read-only in-memory copy of the products table.
+
+    Rows are sorted by product_id so an id lookup is a binary search over a
+    fixed-width byte array. Categorical attributes are stored as uint8 codes
+    (uint16 once a column has more than 256 distinct values) into a sorted
+    vocabulary, year as int16 and all display names in one UTF-8 string pool
+    addressed by an offsets array.
+
+    Memory footprint per million products, for this dataset:
+        categorical codes   7 columns x 1 B     ~  7 MB
+        year                2 B                 ~  2 MB
+        product ids         fixed width, ~5 B   ~  5 MB
+        name offsets        4 B                 ~  4 MB
+        name pool           ~35 B average       ~ 35 MB
+        total                                   ~ 55 MB
+    compared to several hundred MB for the same rows as Python dicts.
+    memory_bytes() reports the exact figure for a loaded catalog.
+    """
+
+    def __init__(self, rows, fingerprint=None):
+        """
+        Args:
+            rows (list): tuples in CATALOG_QUERY column order.
+            fingerprint: value of catalog_fingerprint() the rows were read at.
+        """
+        self.fingerprint = fingerprint
+        ids = np.array([str(row[0]).encode("utf-8") for row in rows], dtype=bytes)
+        order = np.argsort(ids, kind="stable")
+        self._ids = ids[order]
+
+        self.vocabularies = {}
+        self._codes = {}
+        for i, column in enumerate(CATEGORICAL_COLUMNS, start=1):
+            values = np.array(
+                ["" if rows[r][i] is None else str(rows[r][i]) for r in order],
+                dtype=object,
+            )
+            vocabulary, codes = np.unique(values, return_inverse=True)
+            self.vocabularies[column] = [str(v) for v in vocabulary]
+            self._codes[column] = codes.astype(_smallest_code_dtype(len(vocabulary)))
+
+        year_index = len(CATEGORICAL_COLUMNS) + 1
+        self._years = np.array(
+            [YEAR_MISSING if rows[r][year_index] is None else int(rows[r][year_index]) for r in order],
+            dtype=np.int16,
+        )
+
+        names = [(rows[r][year_index + 1] or "").encode("utf-8") for r in order]
+        lengths = np.fromiter((len(n) for n in names), dtype=np.int64, count=len(names))
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        offset_dtype = np.uint32 if offsets[-1] <= np.iinfo(np.uint32).max else np.int64
+        self._name_offsets = offsets.astype(offset_dtype)
+        self._name_pool = b"".join(names)
+
+    @classmethod
+    def load(cls, conn):
+        """Read the whole products table into a new catalog."""
+        fingerprint = catalog_fingerprint(conn)
+        with conn.cursor() as cur:
+            cur.execute(CATALOG_QUERY)
+            rows = cur.fetchall()
+        return cls(rows, fingerprint)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def memory_bytes(self):
+        """Return the number of bytes held by the catalog arrays."""
+        return (
+            self._ids.nbytes
+            + sum(codes.nbytes for codes in self._codes.values())
+            + self._years.nbytes
+            + self._name_offsets.nbytes
+            + len(self._name_pool)
+        )
+
+    def values(self, column):
+        """Return the sorted distinct non-empty values of a categorical column."""
+        return [v for v in self.vocabularies[column] if v]
+
+    def codes(self, column):
+        """Return the per-row integer codes of a categorical column."""
+        return self._codes[column]
+
+    @property
+    def ids(self):
+        """Sorted product ids, as a fixed-width byte array."""
+        return self._ids
+
+    @property
+    def years(self):
+        return self._years
+
+    def product_id(self, row):
+        return self._ids[row].decode("utf-8")
+
+    def name(self, row):
+        start, end = self._name_offsets[row], self._name_offsets[row + 1]
+        return self._name_pool[start:end].decode("utf-8")
+
+    def rows_for(self, product_ids):
+        """Return the row of each product id, or -1 for unknown ids."""
+        encoded = [str(pid).encode("utf-8") for pid in product_ids]
+        if not encoded or len(self._ids) == 0:
+            return np.full(len(encoded), -1, dtype=np.int64)
+        # Ids wider than the stored ones cannot be in the catalog
+        fits = np.array([len(k) <= self._ids.itemsize for k in encoded])
+        keys = np.array(encoded, dtype=self._ids.dtype)
+        rows = np.searchsorted(self._ids, keys)
+        rows[rows == len(self._ids)] = 0
+        return np.where(fits & (self._ids[rows] == keys), rows, -1)
+
+    def mask(self, year_range=None, **filters):
+        """
+        Return a boolean row mask for the given filters.
+
+        Args:
+            year_range (tuple): inclusive (first, last) year, or None.
+            **filters: categorical column -> value or list of accepted values.
+                Empty or None filters are ignored.
+        Returns:
+            numpy.ndarray: True for rows that match every filter.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for column, accepted in filters.items():
+            if not accepted:
+                continue
+            if isinstance(accepted, str):
+                accepted = [accepted]
+            vocabulary = self.vocabularies[column]
+            wanted = [vocabulary.index(v) for v in accepted if v in vocabulary]
+            mask &= np.isin(self._codes[column], wanted)
+        if year_range is not None:
+            first, last = year_range
+            mask &= (self._years >= first) & (self._years <= last)
+        return mask
+
+    def hydrate(self, product_ids):
+        """
+        Return display details for the product ids, skipping unknown ids.
+
+        Returns:
+            list: dicts with product_id, name and image_path, in input order.
+        """
+        products = []
+        for pid, row in zip(product_ids, self.rows_for(product_ids)):
+            if row < 0:
+                continue
+            product_id = self.product_id(row)
+            products.append(
+                {
+                    "product_id": product_id,
+                    "name": self.name(row),
+                    "image_path": f"dataset/images/{product_id}.jpg",
+                }
+            )
+        return products
+
+
+class CatalogCache:
+    """
+    Process-wide holder of the current ProductCatalog.
+
+    The products fingerprint is checked at most every ``check_interval``
+    seconds and the catalog is reloaded when it changed.
+    """
+
+    def __init__(self, check_interval=30.0):
+        self.check_interval = check_interval
+        self._catalog = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, conn):
+        with self._lock:
+            now = time.monotonic()
+            if self._catalog is None:
+                self._catalog = ProductCatalog.load(conn)
+                self._checked_at = now
+            elif now - self._checked_at >= self.check_interval:
+                self._checked_at = now
+                if catalog_fingerprint(conn) != self._catalog.fingerprint:
+                    self._catalog = ProductCatalog.load(conn)
+            return self._catalog
@@ -0,0 +1,180 @@
+import threading
+import time
+import weakref
+
+import psycopg2
+from psycopg2 import errors
+
+# Hot statements of the application, by name: (parameter types, SQL).
+# Each one is prepared once per connection with PREPARE and then run with
+# EXECUTE, so the server parses and plans it once and the values are always
+# bound parameters.
+STATEMENTS = {
+    "retrieve_text": (
+        ("text", "text", "integer"),
+        "SELECT * FROM aidb.retrieve_text($1, $2, $3)",
+    ),
+    "retrieve_image": (
+        ("text", "bytea", "integer"),
+        "SELECT * FROM aidb.retrieve_key($1, $2, $3)",
+    ),
+    # Same retrievals re-ranked by the review stats of the products: the
+    # distance is lowered by $4 for every star of Bayesian rating above 3.
+    # Image keys are file names, the product id is the name without extension.
+    "retrieve_text_by_reviews": (
+        ("text", "text", "integer", "float8"),
+        """SELECT r.key FROM aidb.retrieve_text($1, $2, $3) AS r
+           LEFT JOIN product_review_stats s ON s.product_id = r.key
+           ORDER BY r.distance - $4 * COALESCE(s.bayesian_rating - 3, 0)""",
+    ),
+    "retrieve_image_by_reviews": (
+        ("text", "bytea", "integer", "float8"),
+        """SELECT r.key FROM aidb.retrieve_key($1, $2, $3) AS r
+           LEFT JOIN product_review_stats s ON s.product_id = split_part(r.key, '.', 1)
+           ORDER BY r.distance - $4 * COALESCE(s.bayesian_rating - 3, 0)""",
+    ),
+    "product_by_id": (
+        ("text",),
+        "SELECT productdisplayname, product_id FROM products WHERE product_id = $1",
+    ),
+    "reviews_by_product": (
+        ("text",),
+        "SELECT user_id, product_id, rating, timestamp, review FROM product_review WHERE product_id = $1",
+    ),
+    "review_stats_by_product": (
+        ("text",),
+        """SELECT review_count, rating_mean, bayesian_rating, recent_mean, rating_trend, sentiment_mean
+           FROM product_review_stats WHERE product_id = $1""",
+    ),
+    "decode_text": (
+        ("text", "text"),
+        "SELECT decode_text FROM aidb.decode_text($1, $2)",
+    ),
+}
+
+REVIEW_COLUMNS = ["user_id", "product_id", "rating", "timestamp", "review"]
+REVIEW_STATS_COLUMNS = ["review_count", "rating_mean", "bayesian_rating", "recent_mean", "rating_trend", "sentiment_mean"]
+
+# Distance given up per star of Bayesian rating when ranking by reviews
+REVIEW_RANK_WEIGHT = 0.02
+
+# Names of the statements already prepared on each connection
+_prepared = weakref.WeakKeyDictionary()
+_stats = {}
+_lock = threading.Lock()
+
+
+def _prepare(cur, conn, name):
+    types, query = STATEMENTS[name]
+    try:
+        cur.execute(f"PREPARE {name} ({', '.join(types)}) AS {query};")
+    except errors.DuplicatePreparedStatement:
+        # Prepared on this session by an earlier owner of the connection
+        pass
+    with _lock:
+        _prepared.setdefault(conn, set()).add(name)
+
+
+def _record(name, seconds, failed):
+    with _lock:
+        stats = _stats.setdefault(name, {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        stats["calls"] += 1
+        stats["errors"] += failed
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+
+def execute(conn, name, params=()):
+    """
+    Run a named statement as a server-side prepared statement.
+
+    The connection must be in autocommit mode, a failing PREPARE would
+    otherwise abort the surrounding transaction.
+
+    Returns:
+        list: all result rows.
+    """
+    start_time = time.perf_counter()
+    failed = True
+    try:
+        with conn.cursor() as cur:
+            if name not in _prepared.get(conn, ()):
+                _prepare(cur, conn, name)
+            placeholders = ", ".join(["%s"] * len(params))
+            statement = f"EXECUTE {name} ({placeholders});" if params else f"EXECUTE {name};"
+            try:
+                cur.execute(statement, params)
+            except errors.InvalidSqlStatementName:
+                # The session lost its statements, e.g. after DISCARD ALL
+                with _lock:
+                    _prepared.pop(conn, None)
+                _prepare(cur, conn, name)
+                cur.execute(statement, params)
+            rows = cur.fetchall()
+        failed = False
+        return rows
+    finally:
+        _record(name, time.perf_counter() - start_time, failed)
+
+
+def statement_stats():
+    """
+    Return the call count and latency of every statement run so far.
+
+    Returns:
+        dict: statement name -> {"calls", "errors", "total_seconds",
+        "max_seconds", "mean_seconds"}
+    """
+    with _lock:
+        stats = {name: dict(values) for name, values in _stats.items()}
+    for values in stats.values():
+        values["mean_seconds"] = values["total_seconds"] / values["calls"] if values["calls"] else 0.0
+    return stats
+
+
+def _keys(rows):
+    # retrieve_* return the key first, either as a column or inside a record
+    return [str(row[0]).split(',')[0].strip('()') for row in rows]
+
+
+def retrieve_text(conn, retriever_name, text_query, k, by_reviews=False):
+    """
+    Return the keys of the k entries of a knowledge base closest to a text.
+
+    With by_reviews the k entries are re-ranked by the review stats of the
+    products in the same statement.
+    """
+    if by_reviews:
+        return _keys(execute(conn, "retrieve_text_by_reviews", (retriever_name, text_query, k, REVIEW_RANK_WEIGHT)))
+    return _keys(execute(conn, "retrieve_text", (retriever_name, text_query, k)))
+
+
+def retrieve_image(conn, retriever_name, image_bytes, k, by_reviews=False):
+    """Return the keys of the k entries of a knowledge base closest to an image, see retrieve_text."""
+    image = psycopg2.Binary(image_bytes)
+    if by_reviews:
+        return _keys(execute(conn, "retrieve_image_by_reviews", (retriever_name, image, k, REVIEW_RANK_WEIGHT)))
+    return _keys(execute(conn, "retrieve_image", (retriever_name, image, k)))
+
+
+def product_by_id(conn, product_id):
+    """Return (productdisplayname, product_id) of a product, or None."""
+    rows = execute(conn, "product_by_id", (str(product_id),))
+    return rows[0] if rows else None
+
+
+def reviews_for_product(conn, product_id):
+    """Return the review rows of a product, in REVIEW_COLUMNS order."""
+    return execute(conn, "reviews_by_product", (str(product_id),))
+
+
+def review_stats(conn, product_id):
+    """Return the review stats of a product in REVIEW_STATS_COLUMNS order, or None."""
+    rows = execute(conn, "review_stats_by_product", (str(product_id),))
+    return rows[0] if rows else None
+
+
+def decode_text(conn, model_name, prompt):
+    """Return the completion of a prompt by an aidb model, or None."""
+    rows = execute(conn, "decode_text", (model_name, prompt))
+    return rows[0][0] if rows else None
@@ -0,0 +1,129 @@
+import atexit
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+# Search queries are logged only when this variable names a JSON lines file
+QUERY_LOG_PATH_ENV = "QUERY_LOG_PATH"
+# Uploaded images are kept, by hash, only when this variable names a directory.
+# Image queries can be replayed only when their image was kept.
+QUERY_LOG_IMAGE_DIR_ENV = "QUERY_LOG_IMAGE_DIR"
+
+
+def image_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class QueryLog:
+    """
+    Asynchronous JSON lines log of search queries.
+
+    record() only puts the entry on a bounded queue, a background thread
+    appends the entries to the file in batches. Entries are dropped, and
+    counted in ``dropped``, when the queue is full rather than slowing
+    down the search.
+    """
+
+    def __init__(self, path, image_dir=None, flush_interval=1.0, max_pending=10000):
+        self.path = path
+        self.image_dir = image_dir
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._stopped = threading.Event()
+        if image_dir:
+            os.makedirs(image_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="query-log", daemon=True)
+        self._thread.start()
+
+    def record(self, mode, query, filters, k, latency, result_ids, image_bytes=None, **extra):
+        """
+        Queue one search for logging.
+
+        Args:
+            mode (str): "text" or "image".
+            query (str): text query, None for image searches.
+            filters (dict): facet selections and year range of the search.
+            k (int): number of results asked for.
+            latency (float): search time in seconds.
+            result_ids (list): returned product ids, in order.
+            image_bytes (bytes): uploaded image of an image search.
+            **extra: additional fields stored as is, e.g. the retriever name.
+        """
+        entry = {
+            "ts": time.time(),
+            "mode": mode,
+            "query": query,
+            "filters": filters,
+            "k": k,
+            "latency_ms": round(latency * 1000, 3),
+            "result_ids": list(result_ids),
+        }
+        if image_bytes is not None:
+            entry["image_sha256"] = image_hash(image_bytes)
+        entry.update(extra)
+        try:
+            self._queue.put_nowait((entry, image_bytes))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, batch):
+        with open(self.path, "a") as f:
+            for entry, image_bytes in batch:
+                f.write(json.dumps(entry) + "\n")
+                if image_bytes is not None and self.image_dir:
+                    image_path = os.path.join(self.image_dir, entry["image_sha256"])
+                    if not os.path.exists(image_path):
+                        with open(image_path, "wb") as image_file:
+                            image_file.write(image_bytes)
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            batch = self._drain()
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError as e:
+                    print(f"Error writing query log {self.path}: {e}")
+
+    def close(self):
+        """Stop the flush thread and write the pending entries."""
+        self._stopped.set()
+        self._thread.join()
+        batch = self._drain()
+        if batch:
+            self._write(batch)
+
+
+_query_log = None
+_query_log_lock = threading.Lock()
+
+
+def get_query_log():
+    """Return the process wide query log, or None when logging is not enabled."""
+    global _query_log
+    path = os.getenv(QUERY_LOG_PATH_ENV)
+    if not path:
+        return None
+    with _query_log_lock:
+        if _query_log is None:
+            _query_log = QueryLog(path, os.getenv(QUERY_LOG_IMAGE_DIR_ENV))
+            atexit.register(_query_log.close)
+        return _query_log
+
+
+def read_query_log(path):
+    """Return the entries of a query log file."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
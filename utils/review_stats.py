@@ -0,0 +1,219 @@
+import numpy as np
+import pandas as pd
+from psycopg2.extras import execute_values
+
+# Weight of the catalog wide mean rating in the Bayesian rating, in reviews.
+# A product needs about this many reviews before its own mean dominates.
+PRIOR_WEIGHT = 5
+
+# The trend compares the mean of the latest reviews of a product to its overall mean
+RECENT_REVIEWS = 10
+
+# Small sentiment lexicon for product reviews, word -> polarity
+SENTIMENT_LEXICON = {
+    **{word: 1.0 for word in (
+        "good", "great", "excellent", "amazing", "awesome", "love", "loved", "perfect", "nice",
+        "comfortable", "comfy", "beautiful", "best", "happy", "recommend", "quality", "soft",
+        "stylish", "fits", "worth", "durable", "fantastic", "pretty", "satisfied", "elegant",
+    )},
+    **{word: -1.0 for word in (
+        "bad", "poor", "terrible", "awful", "worst", "hate", "cheap", "broke", "broken", "tight",
+        "loose", "uncomfortable", "disappointed", "disappointing", "return", "returned", "waste",
+        "faded", "torn", "small", "large", "itchy", "flimsy", "defective", "wrong", "late",
+    )},
+}
+# A negation flips the polarity of the next word
+NEGATIONS = {"not", "no", "never", "don't", "didn't", "isn't", "wasn't", "doesn't"}
+
+STATS_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS product_review_stats (
+        product_id TEXT PRIMARY KEY,
+        review_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum BIGINT NOT NULL DEFAULT 0,
+        sentiment_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        rating_mean DOUBLE PRECISION,
+        bayesian_rating DOUBLE PRECISION,
+        recent_count INTEGER,
+        recent_mean DOUBLE PRECISION,
+        rating_trend DOUBLE PRECISION,
+        sentiment_mean DOUBLE PRECISION,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+_UPSERT_SQL = """
+    INSERT INTO product_review_stats AS s (product_id, review_count, rating_sum, sentiment_sum)
+    VALUES %s
+    ON CONFLICT (product_id) DO UPDATE SET
+        review_count = s.review_count + EXCLUDED.review_count,
+        rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+        sentiment_sum = s.sentiment_sum + EXCLUDED.sentiment_sum;
+"""
+
+_REFRESH_SQL = """
+    WITH latest AS (
+        SELECT product_id, rating,
+               row_number() OVER (PARTITION BY product_id ORDER BY timestamp DESC) AS position
+        FROM product_review
+        WHERE product_id = ANY(%(product_ids)s) AND rating IS NOT NULL
+    ), recent AS (
+        SELECT product_id, count(*) AS recent_count, avg(rating)::float8 AS recent_mean
+        FROM latest WHERE position <= %(recent_reviews)s GROUP BY product_id
+    ), prior AS (
+        SELECT sum(rating_sum)::float8 / NULLIF(sum(review_count), 0) AS mean FROM product_review_stats
+    )
+    UPDATE product_review_stats s SET
+        rating_mean = s.rating_sum::float8 / NULLIF(s.review_count, 0),
+        bayesian_rating = (%(prior_weight)s * prior.mean + s.rating_sum) / (%(prior_weight)s + s.review_count),
+        recent_count = recent.recent_count,
+        recent_mean = recent.recent_mean,
+        rating_trend = recent.recent_mean - s.rating_sum::float8 / NULLIF(s.review_count, 0),
+        sentiment_mean = s.sentiment_sum / NULLIF(s.review_count, 0),
+        updated_at = now()
+    FROM recent, prior
+    WHERE s.product_id = recent.product_id;
+"""
+
+# The prior moves with every batch, this brings all Bayesian ratings up to date
+_REFRESH_PRIOR_SQL = """
+    WITH prior AS (
+        SELECT sum(rating_sum)::float8 / NULLIF(sum(review_count), 0) AS mean FROM product_review_stats
+    )
+    UPDATE product_review_stats s SET
+        bayesian_rating = (%(prior_weight)s * prior.mean + s.rating_sum) / (%(prior_weight)s + s.review_count)
+    FROM prior;
+"""
+
+
+def sentiment_scores(reviews):
+    """
+    Score review texts from -1 (negative) to 1 (positive) with the lexicon.
+
+    The score is (positive - negative) / (positive + negative) over the
+    lexicon words of each review, 0 when it has none. All reviews of a batch
+    are tokenized and scored with vectorized pandas operations.
+
+    Args:
+        reviews (pandas.Series): review texts, may contain NaN.
+    Returns:
+        numpy.ndarray: one score per review.
+    """
+    reviews = pd.Series(reviews).reset_index(drop=True)
+    words = reviews.fillna("").str.lower().str.findall(r"[a-z']+").explode()
+    polarity = words.map(SENTIMENT_LEXICON).fillna(0.0).astype(float)
+    # The word before each word of the same review, for negations
+    previous = words.groupby(level=0).shift(1)
+    polarity = polarity.where(~previous.isin(NEGATIONS), -polarity)
+    positive = polarity.clip(lower=0).groupby(level=0).sum()
+    negative = (-polarity).clip(lower=0).groupby(level=0).sum()
+    total = positive + negative
+    scores = ((positive - negative) / total.where(total > 0)).fillna(0.0)
+    return scores.reindex(range(len(reviews)), fill_value=0.0).to_numpy()
+
+
+def _add_to_stats(cur, reviews):
+    """Add the counts and sums of a batch of reviews to product_review_stats, return its product ids."""
+    ratings = pd.to_numeric(reviews["rating"], errors="coerce")
+    # Reviews without a usable rating are stored with a NULL one and not counted
+    rated = reviews[ratings.notna().to_numpy()]
+    if rated.empty:
+        return []
+    batch = pd.DataFrame(
+        {
+            "product_id": rated["product_id"].astype(str).to_numpy(),
+            "rating": ratings.dropna().astype(np.int64).to_numpy(),
+            "sentiment": sentiment_scores(rated["review"]),
+        }
+    )
+    per_product = batch.groupby("product_id").agg(
+        review_count=("rating", "size"), rating_sum=("rating", "sum"), sentiment_sum=("sentiment", "sum")
+    )
+    rows = [
+        (product_id, int(count), int(rating_sum), float(sentiment_sum))
+        for product_id, count, rating_sum, sentiment_sum in per_product.itertuples()
+    ]
+    execute_values(cur, _UPSERT_SQL, rows, page_size=1000)
+    return list(per_product.index)
+
+
+def _refresh(cur, product_ids, refresh_prior):
+    params = {"product_ids": product_ids, "recent_reviews": RECENT_REVIEWS, "prior_weight": PRIOR_WEIGHT}
+    cur.execute(_REFRESH_SQL, params)
+    if refresh_prior:
+        cur.execute(_REFRESH_PRIOR_SQL, params)
+
+
+def update_review_stats(conn, reviews, refresh_prior=True):
+    """
+    Fold a batch of new reviews into product_review_stats.
+
+    Counts and sums are added to the existing rows; the means, the
+    Bayesian rating and the trend of the products of the batch are then
+    recomputed in the database from those sums and their latest reviews.
+    Reviews without a numeric rating are left out.
+
+    Args:
+        conn: connection to the primary.
+        reviews (pandas.DataFrame): the new reviews, already inserted into
+            product_review, with product_id, rating and review columns.
+        refresh_prior (bool): also update the Bayesian rating of products
+            not in the batch, whose prior mean moved. Worth it for bulk
+            loads, not for a single review.
+    """
+    if reviews.empty:
+        return
+    with conn.cursor() as cur:
+        product_ids = _add_to_stats(cur, reviews)
+        if product_ids:
+            _refresh(cur, product_ids, refresh_prior)
+
+
+def rebuild_review_stats(conn, chunk_size=50000):
+    """
+    Recompute product_review_stats from scratch from product_review.
+
+    Used after bulk loads, which may replace reviews already counted. The
+    reviews are read in chunks through a server-side cursor, so the
+    connection must not be in autocommit mode.
+    """
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM product_review_stats;")
+    with conn.cursor(name="review_stats_rebuild") as reader, conn.cursor() as cur:
+        reader.itersize = chunk_size
+        reader.execute("SELECT product_id, rating, review FROM product_review;")
+        while True:
+            rows = reader.fetchmany(chunk_size)
+            if not rows:
+                break
+            _add_to_stats(cur, pd.DataFrame(rows, columns=["product_id", "rating", "review"]))
+    with conn.cursor() as cur:
+        cur.execute("SELECT product_id FROM product_review_stats;")
+        product_ids = [row[0] for row in cur.fetchall()]
+        if product_ids:
+            _refresh(cur, product_ids, refresh_prior=False)
+
+
+def record_review(conn, user_id, product_id, rating, review):
+    """
+    Store a new review and fold it into the stats of its product, in one transaction.
+
+    Args:
+        conn: connection to the primary, in any autocommit mode.
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO product_review (user_id, product_id, rating, review) VALUES (%s, %s, %s, %s);",
+                (user_id, str(product_id), int(rating), review),
+            )
+        reviews = pd.DataFrame([{"product_id": str(product_id), "rating": rating, "review": review}])
+        # A single review barely moves the prior of the other products
+        update_review_stats(conn, reviews, refresh_prior=False)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = autocommit
@@ -0,0 +1,38 @@
+from utils import queries
+
+
+def _filtered(retrieve, facets, query_value, k, bits):
+    """
+    Run a retriever and keep the first k product ids of the candidate set.
+
+    The retriever is over sampled according to the selectivity of the filters.
+    """
+    fetch_k = facets.retrieve_k(k, bits)
+    if fetch_k == 0:
+        return []
+    keys = retrieve(query_value, fetch_k)
+    # Image keys are file names, the product id is the name without extension
+    keys = [key.split(".")[0] for key in keys]
+    return facets.filter_ids(keys, bits, k)
+
+
+def search_text(conn, facets, retriever_name, text_query, k, selections, year_range=None, by_reviews=False):
+    """
+    Return the ids of the k products closest to a text query that match the filters.
+
+    With by_reviews well reviewed products move up, see queries.retrieve_text.
+    """
+    bits = facets.candidates(selections, year_range)
+    return _filtered(
+        lambda query, fetch_k: queries.retrieve_text(conn, retriever_name, query, fetch_k, by_reviews),
+        facets, text_query, k, bits,
+    )
+
+
+def search_image(conn, facets, retriever_name, image_bytes, k, selections, year_range=None, by_reviews=False):
+    """Return the ids of the k products closest to an image that match the filters."""
+    bits = facets.candidates(selections, year_range)
+    return _filtered(
+        lambda image, fetch_k: queries.retrieve_image(conn, retriever_name, image, fetch_k, by_reviews),
+        facets, image_bytes, k, bits,
+    )